@@ -1,25 +1,174 @@
+import asyncio
+import logging
+import secrets
+from collections import OrderedDict
 from time import time
 from datetime import datetime, timedelta
 from typing import Annotated
 
-from sqlalchemy import select
+from sqlalchemy import select, delete, update
 from sqlalchemy.exc import NoResultFound, IntegrityError
-from fastapi import Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
+from app import bus
 from app.utils import JWTmgmt, hashing
-from app.db import session_genr
+from app.db import session_scope, transaction, request_session, release
 from app.db.models import ExpToken, User as UserDB
-from app.config import JWT_EXPIRY_TIMEDELTA
+from app.config import (
+    JWT_EXPIRY_TIMEDELTA,
+    AUTH_CACHE_TTL,
+    AUTH_CACHE_SIZE,
+    REVOKED_SWEEP_INTERVAL,
+)
 
 bearer_passwd = OAuth2PasswordBearer("/auth/login")
 bearer_passwd_form = OAuth2PasswordRequestForm
 
 
+# Rate limiter identifiers, throttling guesses at one account or team however
+# many addresses they come from. The body is parsed before dependencies run,
+# so these get FastAPI's cached copy.
+async def username_identifier(request: Request) -> str:
+    form = await request.form()
+    return "username:" + str(form.get("username", ""))
+
+
+async def team_name_identifier(request: Request) -> str:
+    try:
+        body = await request.json()
+    except ValueError:
+        # Not JSON, the route's own validation answers with a 422
+        body = None
+    return "team:" + str(body.get("name", "") if isinstance(body, dict) else "")
+
+# Principal cache: jti -> (cached until, user). The users are detached
+# snapshots with their team loaded, evicted through the bus when the user,
+# their team membership or the token changes.
+principals: OrderedDict[str, tuple[float, UserDB]] = OrderedDict()
+# Bumped on every eviction, so a lookup racing one doesn't cache stale data
+invalidations = 0
+# Revoked, still unexpired tokens: jti -> exp. Mirrors the revoked_tokens
+# table, loaded on start and kept in sync through the bus, so checking a
+# token never needs the database.
+revoked: dict[str, float] = {}
+sweeper: asyncio.Task | None = None
+
+
+async def init() -> None:
+    global sweeper
+    # Subscribe before loading so no revocation is missed in between
+    bus.subscribe("token_expire", revoke)
+    for kind in (
+        "user_update",
+        "user_delete",
+        "team_create",
+        "team_update",
+        "team_delete",
+        "team_join",
+        "team_leave",
+        "token_expire",
+    ):
+        bus.subscribe(kind, invalidate)
+    bus.on_resync(reload)
+    await load_revoked()
+    sweeper = asyncio.create_task(sweep_revoked())
+
+
+async def close() -> None:
+    if sweeper:
+        sweeper.cancel()
+        try:
+            await sweeper
+        except asyncio.CancelledError:
+            pass
+
+
+async def reload() -> None:
+    # Any cached principal may have missed an eviction
+    global invalidations
+    invalidations += 1
+    principals.clear()
+    await load_revoked()
+
+
+def revoke(msg: bus.Message) -> None:
+    revoked[msg.data["jti"]] = msg.data["exp"]
+
+
+async def load_revoked() -> None:
+    # Added to what the bus brought, a revocation is in the table before its
+    # message goes out
+    async with session_scope() as session:
+        rows = await session.execute(
+            select(ExpToken.jti, ExpToken.exp).where(ExpToken.exp >= datetime.now())
+        )
+        for row in rows:
+            revoked.setdefault(row.jti, row.exp.timestamp())
+
+
+async def sweep_revoked() -> None:
+    # Expired tokens are rejected anyway, so their revocations can go. The
+    # table is read again too, for revocations whose bus message was lost.
+    while True:
+        await asyncio.sleep(REVOKED_SWEEP_INTERVAL)
+        now = time()
+        for jti in [jti for jti, exp in revoked.items() if exp < now]:
+            del revoked[jti]
+        try:
+            async with session_scope() as session:
+                async with transaction(session):
+                    await session.execute(
+                        delete(ExpToken).where(
+                            ExpToken.exp < datetime.fromtimestamp(now)
+                        )
+                    )
+            await load_revoked()
+        except Exception:
+            logging.exception("Sweeping revoked tokens failed")
+
+
+def invalidate(msg: bus.Message) -> None:
+    global invalidations
+    invalidations += 1
+    if msg.kind == "token_expire":
+        principals.pop(msg.data["jti"], None)
+        return
+    if msg.kind == "team_update":
+        stale = lambda user: user.team and user.team.id == msg.data["team_id"]
+    elif msg.kind == "team_delete":
+        stale = lambda user: user.id in msg.data["user_ids"]
+    else:
+        stale = lambda user: user.id == msg.data["user_id"]
+    # Rare enough that a scan beats keeping indexes up to date
+    for key in [key for key, (_, user) in principals.items() if stale(user)]:
+        del principals[key]
+
+
+def cached_principal(key: str) -> UserDB | None:
+    entry = principals.get(key)
+    if not entry:
+        return None
+    if entry[0] < time():
+        del principals[key]
+        return None
+    principals.move_to_end(key)
+    return entry[1]
+
+
+def cache_principal(key: str, user: UserDB) -> None:
+    principals[key] = (time() + AUTH_CACHE_TTL, user)
+    principals.move_to_end(key)
+    while len(principals) > AUTH_CACHE_SIZE:
+        principals.popitem(last=False)
+
+
 async def gen_token(username: str) -> str:
     return JWTmgmt.generate_token(
         {
             "username": username,
+            "jti": secrets.token_urlsafe(16),
             "exp": int(
                 (datetime.now() + timedelta(minutes=JWT_EXPIRY_TIMEDELTA)).timestamp()
             ),
@@ -28,53 +177,77 @@ async def gen_token(username: str) -> str:
 
 
 async def verify_user_passwd(username: str, passwd: str) -> bool:
-    async with session_genr() as session:
-        stmt = select(UserDB.pass_hash).filter_by(username=username)
+    async with session_scope() as session:
+        stmt = select(UserDB.id, UserDB.pass_hash).filter_by(username=username)
         results = await session.execute(stmt)
         try:
-            stored_hash = results.one().pass_hash
+            user_id, stored_hash = results.one()
         except NoResultFound:
             return False
-        if not hashing.verify(passwd, stored_hash):
-            return False
-    return True
+        # No pooled connection is held while hashing
+        await release(session)
+    valid, new_hash = await hashing.verify_and_update_async(passwd, stored_hash)
+    if new_hash:
+        # Hashed with outdated costs. Only replaced if unchanged meanwhile, so
+        # a concurrent password change wins.
+        async with session_scope() as session:
+            async with transaction(session):
+                await session.execute(
+                    update(UserDB)
+                    .where(UserDB.id == user_id, UserDB.pass_hash == stored_hash)
+                    .values(pass_hash=new_hash)
+                )
+    return valid
 
 
 async def expire_token(token: str) -> bool:
-    async with session_genr() as session:
-        async with session.begin():
-            try:
-                session.add(ExpToken(token=token))
-            except IntegrityError:
-                return False
+    token_data = JWTmgmt.verify_token(token)
+    if not token_data or "jti" not in token_data:
+        return False
+    jti, exp = token_data["jti"], token_data["exp"]
+    async with session_scope() as session:
+        try:
+            async with transaction(session):
+                session.add(ExpToken(jti=jti, exp=datetime.fromtimestamp(exp)))
+        except IntegrityError:
+            return False
+    await bus.publish("token_expire", jti=jti, exp=exp)
     return True
 
 
-async def verify_token(token: Annotated[str, Depends(bearer_passwd)]) -> UserDB:
+async def verify_token(
+    token: Annotated[str, Depends(bearer_passwd)],
+    session: Annotated[AsyncSession, Depends(request_session)],
+) -> UserDB:
     exc = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Bearer token invalid",
         headers={"WWW-Authenticate": "Bearer"},
     )
     token_data = JWTmgmt.verify_token(token)
-    if not token_data:
+    # Tokens from before jti was added can't be revoked, so aren't accepted
+    if not token_data or "jti" not in token_data or token_data.get("exp", 0) < time():
         raise exc
-    async with session_genr() as session:
-        try:
-            (await session.execute(select(ExpToken.id).filter_by(token=token))).one()
-        except NoResultFound:
-            pass
-        else:
-            raise exc
-        try:
-            user = (
-                await session.execute(
-                    select(UserDB).filter_by(username=token_data["username"])
-                )
-            ).scalar_one()
-            await user.awaitable_attrs.team
-        except (KeyError, NoResultFound):
-            raise exc
-    if token_data["exp"] < time():
+    key = token_data["jti"]
+    if key in revoked:
+        raise exc
+    if user := cached_principal(key):
+        return user
+    seen_invalidations = invalidations
+    try:
+        user = (
+            await session.execute(
+                select(UserDB).filter_by(username=token_data["username"])
+            )
+        ).scalar_one()
+        team = await user.awaitable_attrs.team
+    except (KeyError, NoResultFound):
         raise exc
+    if AUTH_CACHE_TTL and seen_invalidations == invalidations:
+        # Detach so the snapshot is never refreshed or expired by a session;
+        # services load their own copy when they need one
+        session.expunge(user)
+        if team:
+            session.expunge(team)
+        cache_principal(key, user)
     return user
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import string
+import tempfile
+from dataclasses import dataclass
+from time import time, perf_counter
+from typing import AsyncIterator, BinaryIO
+
+import aiofiles
+from aiofiles.tempfile.temptypes import AsyncTemporaryDirectory
+from sqlalchemy import select
+
+from app.db import session_scope, engine
+from app.db.models import File as FileDB
+from app.config import FILE_STORE_DIR, FILE_ORPHAN_GRACE, FILE_BUFF_SIZE
+
+# Content-addressed store of challenge files. A blob is named by the sha256
+# of its content and shared by every file with that digest as path, and is
+# removed once none is left. Blobs written in the last FILE_ORPHAN_GRACE
+# seconds are spared, an upload of the same content may be about to refer
+# to them; the sweep collects them later if not.
+
+TMP_SUFFIX = ".tmp"
+# Compressed copies made by app.delivery, removed along with their blob
+VARIANT_ENCODINGS = ("zstd", "gzip")
+
+store_dir: AsyncTemporaryDirectory | None = None
+root = ""
+
+
+async def init():
+    global store_dir, root
+    if not FILE_STORE_DIR:
+        store_dir = await aiofiles.tempfile.TemporaryDirectory()
+        root = store_dir.name
+    else:
+        store_dir = None
+        root = FILE_STORE_DIR
+
+
+async def cleanup():
+    if store_dir:
+        await store_dir.cleanup()
+
+
+def path(digest: str) -> str:
+    return os.path.join(root, digest)
+
+
+def variant_path(digest: str, encoding: str) -> str:
+    return f"{path(digest)}.{encoding}"
+
+
+class TooLarge(Exception):
+    """
+    The upload is over the size limit.
+    """
+
+
+@dataclass(slots=True)
+class Metrics:
+    uploads: int = 0
+    failed: int = 0  # too large, cut short or not writable
+    bytes: int = 0
+    time: float = 0  # total, in seconds
+    last_throughput: float = 0  # of the last upload, in MiB/s
+
+
+metrics = Metrics()
+
+
+def write(out: BinaryIO, sha256, parts: list[bytes]) -> None:
+    # Both release the GIL, so this runs in a thread without holding up the
+    # event loop
+    for part in parts:
+        sha256.update(part)
+        out.write(part)
+
+
+def finish(out: BinaryIO, sha256, parts: list[bytes]) -> None:
+    write(out, sha256, parts)
+    out.flush()
+    os.fsync(out.fileno())
+    out.close()
+
+
+def promote(tmp_path: str, digest: str) -> None:
+    # Atomic, the blob is either missing or complete. Replacing one of the
+    # same content also makes it fresh again for the grace period.
+    os.replace(tmp_path, path(digest))
+    # Makes the rename itself durable
+    dir_fd = os.open(root, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+async def store(chunks: AsyncIterator[bytes], max_size: int) -> str:
+    """
+    Writes `chunks` to the store and returns their digest. Hashing and
+    writing happen in a thread, FILE_BUFF_SIZE at a time, while the next
+    chunks are read. Raises TooLarge past `max_size` bytes.
+    """
+    started = perf_counter()
+    fd, tmp_path = await asyncio.to_thread(
+        tempfile.mkstemp, dir=root, suffix=TMP_SUFFIX
+    )
+    out = os.fdopen(fd, "wb")
+    sha256 = hashlib.sha256()
+    size = 0
+    parts: list[bytes] = []
+    buffered = 0
+    writing: asyncio.Future | None = None
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise TooLarge
+            parts.append(chunk)
+            buffered += len(chunk)
+            if buffered >= FILE_BUFF_SIZE:
+                if writing:
+                    await writing
+                writing = asyncio.ensure_future(
+                    asyncio.to_thread(write, out, sha256, parts)
+                )
+                parts = []
+                buffered = 0
+        if writing:
+            await writing
+        await asyncio.to_thread(finish, out, sha256, parts)
+        digest = sha256.hexdigest()
+        await asyncio.to_thread(promote, tmp_path, digest)
+    except BaseException:
+        metrics.failed += 1
+        # The file can't be closed under a write still running
+        if writing and not writing.done():
+            await asyncio.wait([writing])
+        out.close()
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    elapsed = perf_counter() - started
+    metrics.uploads += 1
+    metrics.bytes += size
+    metrics.time += elapsed
+    metrics.last_throughput = size / 2**20 / elapsed if elapsed else 0
+    logging.info(
+        "Stored %s, %d bytes in %.2fs (%.1f MiB/s)",
+        digest,
+        size,
+        elapsed,
+        metrics.last_throughput,
+    )
+    return digest
+
+
+def remove_stale(blob_path: str, cutoff: float) -> bool:
+    try:
+        if os.stat(blob_path).st_mtime > cutoff:
+            return False
+        os.unlink(blob_path)
+    except FileNotFoundError:
+        return False
+    for encoding in VARIANT_ENCODINGS:
+        try:
+            os.unlink(f"{blob_path}.{encoding}")
+        except FileNotFoundError:
+            pass
+    return True
+
+
+async def release(digests: list[str]) -> None:
+    """
+    Removes the blobs of `digests` no file refers to anymore. Called after
+    the files are deleted.
+    """
+    unique = set(digests)
+    if not unique:
+        return
+    async with session_scope() as session:
+        used = set(
+            await session.scalars(
+                select(FileDB.path).where(FileDB.path.in_(unique)).distinct()
+            )
+        )
+    cutoff = time() - FILE_ORPHAN_GRACE
+    for digest in unique - used:
+        await asyncio.to_thread(remove_stale, path(digest), cutoff)
+
+
+def is_blob(name: str) -> bool:
+    return len(name) == 64 and all(c in string.hexdigits for c in name)
+
+
+async def sweep() -> int:
+    """
+    Removes the blobs no file refers to and temp files left by failed
+    uploads. Returns how many were removed.
+    """
+    async with session_scope() as session:
+        used = set(await session.scalars(select(FileDB.path).distinct()))
+    cutoff = time() - FILE_ORPHAN_GRACE
+    removed = 0
+    for entry in await asyncio.to_thread(lambda: list(os.scandir(root))):
+        digest, _, suffix = entry.name.partition(".")
+        if not entry.is_file():
+            continue
+        # Temp files of uploads and compressions go once they stop changing
+        if not entry.name.endswith(TMP_SUFFIX) and (
+            digest in used
+            or not (is_blob(digest) and suffix in ("", *VARIANT_ENCODINGS))
+        ):
+            continue
+        if await asyncio.to_thread(remove_stale, entry.path, cutoff):
+            removed += 1
+    return removed
+
+
+def main():
+    argparse.ArgumentParser(
+        prog="python -m app.blobstore",
+        description="Remove stored files no challenge refers to anymore",
+    ).parse_args()
+    if not FILE_STORE_DIR:
+        print("FILE_STORE_DIR isn't set, files only live as long as the server")
+        return
+
+    async def run():
+        await init()
+        try:
+            print(f"Removed {await sweep()} files")
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import redis.asyncio as redis
+
+from app.config import BUS_ECHO_TIMEOUT
+
+# Mutation events, fanned out to every worker over Redis pub/sub so that
+# in-process state (scoreboard, SSE feed, ...) stays consistent. Every
+# message gets a global, monotonic sequence number and handlers run in that
+# order on every worker: a worker's own messages are applied when they come
+# back through the subscription, and publishing waits for that. If Redis
+# can't be reached, messages are applied locally without a sequence number.
+# Pub/sub delivers at most once, so whenever messages may have been missed (a
+# gap in the sequence, a reconnect, an echo that doesn't come back, or
+# messages the other workers never saw) the state is reloaded from the
+# database through the resync handlers.
+
+CHANNEL = "flagged:bus"
+SEQ_KEY = "flagged:bus:seq"
+
+# Assigns consecutive sequence numbers and publishes atomically, so all
+# workers see messages in sequence order
+PUBLISH_LUA = """
+local seq = redis.call('INCRBY', KEYS[1], #ARGV) - #ARGV
+for i, msg in ipairs(ARGV) do
+    redis.call('PUBLISH', KEYS[2], (seq + i) .. ' ' .. msg)
+end
+return seq
+"""
+
+
+@dataclass(slots=True)
+class Message:
+    seq: int | None  # None if only applied on this worker
+    kind: str
+    data: dict
+
+
+handlers: dict[str, list[Callable[[Message], None]]] = defaultdict(list)
+resync_handlers: list[Callable[[], Awaitable[None]]] = []
+last_seq = 0
+# Publishers waiting for their last message to be applied, by its seq
+applied: dict[int, asyncio.Future] = {}
+conn: redis.Redis | None = None
+publish_script = None
+listener: asyncio.Task | None = None
+resyncer: asyncio.Task | None = None
+# Set again when a resync is asked for during one, whose reads may be too old
+resync_pending = False
+# Messages were applied here only, the other workers are told to resync once
+# Redis is back
+diverged = False
+
+
+def subscribe(kind: str, handler: Callable[[Message], None]) -> None:
+    if handler not in handlers[kind]:
+        handlers[kind].append(handler)
+
+
+def on_resync(handler: Callable[[], Awaitable[None]]) -> None:
+    if handler not in resync_handlers:
+        resync_handlers.append(handler)
+
+
+def resync(reason: str) -> asyncio.Task:
+    """
+    Reloads the state kept in sync through the bus, in the background. The
+    returned task ends once it is done.
+    """
+    global resyncer, resync_pending
+    logging.warning("Bus messages may have been missed (%s), resyncing", reason)
+    resync_pending = True
+    if not resyncer or resyncer.done():
+        resyncer = asyncio.create_task(run_resync())
+    return resyncer
+
+
+def resync_asked(msg: Message) -> None:
+    resync("asked by another worker")
+
+
+async def run_resync() -> None:
+    global resync_pending
+    while resync_pending:
+        resync_pending = False
+        for handler in resync_handlers:
+            try:
+                await handler()
+            except Exception:
+                logging.exception("Bus resync handler failed")
+
+
+def dispatch(msg: Message) -> None:
+    global last_seq
+    if msg.seq is not None:
+        last_seq = msg.seq
+    for handler in handlers[msg.kind]:
+        try:
+            handler(msg)
+        except Exception:
+            logging.exception("Bus handler failed for %s", msg.kind)
+    if msg.seq is not None and (waiter := applied.pop(msg.seq, None)):
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+async def publish(kind: str, **data) -> None:
+    await publish_many([(kind, data)])
+
+
+async def publish_many(messages: list[tuple[str, dict]]) -> None:
+    """
+    Returns once the messages are applied on this worker, or once the state
+    is reloaded if they don't come back within BUS_ECHO_TIMEOUT.
+    """
+    global diverged
+    sent = [("resync", {}), *messages] if diverged else messages
+    try:
+        if not publish_script:
+            raise ConnectionError("Bus not connected")
+        seq = await publish_script(
+            keys=[SEQ_KEY, CHANNEL],
+            args=[json.dumps({"kind": kind, "data": data}) for kind, data in sent],
+        )
+    except Exception:
+        # Keep this worker consistent even if the others can't be told
+        logging.exception("Publishing to the bus failed, applying locally")
+        diverged = True
+        for kind, data in messages:
+            dispatch(Message(seq=None, kind=kind, data=data))
+        return
+    if sent is not messages:
+        diverged = False
+    last = seq + len(sent)
+    # The listener may have got there first
+    if last_seq >= last:
+        return
+    waiter = applied[last] = asyncio.get_running_loop().create_future()
+    try:
+        await asyncio.wait_for(waiter, BUS_ECHO_TIMEOUT)
+    except TimeoutError:
+        # The reload reads the write from the database instead
+        await asyncio.shield(resync(f"message {last} not back in time"))
+    finally:
+        applied.pop(last, None)
+
+
+async def announce_resync() -> None:
+    global diverged
+    try:
+        await publish_script(
+            keys=[SEQ_KEY, CHANNEL],
+            args=[json.dumps({"kind": "resync", "data": {}})],
+        )
+    except Exception:
+        logging.exception("Asking the other workers to resync failed")
+    else:
+        diverged = False
+
+
+async def listen(pubsub) -> None:
+    reconnecting = False
+    while True:
+        try:
+            async for raw in pubsub.listen():
+                if raw["type"] == "subscribe" and reconnecting:
+                    # Resubscribed, whatever was published meanwhile is lost
+                    reconnecting = False
+                    resync("reconnected")
+                    if diverged:
+                        await announce_resync()
+                if raw["type"] != "message":
+                    continue
+                seq, payload = raw["data"].split(" ", 1)
+                seq = int(seq)
+                if seq <= last_seq:
+                    continue
+                if seq > last_seq + 1:
+                    resync(f"got {seq} after {last_seq}")
+                msg = json.loads(payload)
+                dispatch(Message(seq=seq, kind=msg["kind"], data=msg["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The pubsub reconnects and resubscribes by itself
+            logging.exception("Bus listener failed, retrying")
+            reconnecting = True
+            await asyncio.sleep(1)
+
+
+async def init(redis_conn: redis.Redis) -> None:
+    global conn, publish_script, listener, last_seq
+    conn = redis_conn
+    publish_script = conn.register_script(PUBLISH_LUA)
+    subscribe("resync", resync_asked)
+    pubsub = conn.pubsub()
+    # Subscribed first, so nothing after the current position is missed
+    await pubsub.subscribe(CHANNEL)
+    last_seq = int(await conn.get(SEQ_KEY) or 0)
+    listener = asyncio.create_task(listen(pubsub))
+
+
+async def close() -> None:
+    for task in (listener, resyncer):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
@@ -1,16 +1,18 @@
 import os
-import hashlib
-import tempfile
-from typing import Literal
+import asyncio
+import logging
+from typing import Literal, AsyncIterator
+from dataclasses import dataclass
 from datetime import datetime
 
-from sqlalchemy import select
+from sqlalchemy import select, insert, union_all, or_, and_
 from sqlalchemy.exc import NoResultFound, IntegrityError
-from fastapi import UploadFile
-from fastapi.responses import FileResponse
-import aiofiles
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from fastapi import Response
 
-from app.db import session_genr
+from app import bus, blobstore, delivery
+from app.db import session_scope, transaction, release
 from app.models.chall import (
     ChallReg,
     ChallUpdate,
@@ -18,52 +20,217 @@ from app.models.chall import (
     SolveForChall,
     ChallSolves,
     FileForChall,
+    FlagReg,
+    FlagForChall,
+    ChallFlags,
+    TeamFlags,
     Chall,
     ChallList,
 )
 from app.db.models import (
-    User as UserDB,
+    Team as TeamDB,
     Chall as ChallDB,
     File as FileDB,
+    Flag as FlagDB,
     Solve as SolveDB,
 )
-from app.utils import hashing
-from app.config import FILE_STORE_DIR, FILE_BUFF_SIZE
-
-
-async def init():
-    global files_dir, files_dir_name
-    if not FILE_STORE_DIR:
-        files_dir = await aiofiles.tempfile.TemporaryDirectory()
-        files_dir_name = files_dir.name  # type: ignore
+from app.utils import hashing, cursor
+from app.utils.scoring import Decay, chall_value
+from app.utils.flagmatch import FlagKind, Matcher, check_flag, team_flag, team_token
+from app.config import FILE_MAX_SIZE
+
+
+# Compiled flag matchers by challenge, so wrong flags are rejected without
+# touching the database. None marks flags changed through the bus, reloaded
+# on the next submission. Flags themselves never go over the bus.
+matchers: dict[int, Matcher | None] = {}
+# Challenge ids looked up and not found, so repeated submissions for them
+# don't each cost a query. A challenge this worker missed the creation of is
+# loaded on its first submission instead.
+unknown_challs: set[int] = set()
+UNKNOWN_CHALLS_MAX = 10000
+# Bumped on every change, so a reload racing one doesn't store stale flags
+flag_changes = 0
+# Personalized flag tokens -> owning team, by challenge. Built on the first
+# submission of a foreign looking token, to catch teams sharing flags.
+flag_owners: dict[int, dict[str, int]] = {}
+team_changes = 0
+
+
+async def load_flags() -> None:
+    for kind in (
+        "chall_create",
+        "chall_update",
+        "chall_delete",
+        "flag_create",
+        "flag_delete",
+    ):
+        bus.subscribe(kind, flag_changed)
+    for kind in ("team_create", "team_delete"):
+        bus.subscribe(kind, team_changed)
+    bus.on_resync(reset_flags)
+    async with session_scope() as session:
+        matchers.clear()
+        flag_owners.clear()
+        unknown_challs.clear()
+        for chall_id, chall_flags in (await accepted_flags(session)).items():
+            matchers[chall_id] = Matcher(chall_id, chall_flags)
+
+
+async def accepted_flags(
+    session: AsyncSession, chall_id: int | None = None
+) -> dict[int, list[tuple[str, str]]]:
+    """
+    (kind, flag) pairs by challenge, of all of them or just `chall_id`.
+    """
+    primary = select(
+        ChallDB.id.label("chall_id"), ChallDB.flag_kind.label("kind"), ChallDB.flag
+    )
+    extra = select(FlagDB.chall_id, FlagDB.kind, FlagDB.flag)
+    if chall_id is not None:
+        primary = primary.where(ChallDB.id == chall_id)
+        extra = extra.where(FlagDB.chall_id == chall_id)
+    flags = {}
+    for row in await session.execute(union_all(primary, extra)):
+        flags.setdefault(row.chall_id, []).append((row.kind, row.flag))
+    return flags
+
+
+async def reset_flags() -> None:
+    # Everything reloads on its next submission, as after a change
+    global flag_changes, team_changes
+    flag_changes += 1
+    team_changes += 1
+    for chall_id in matchers:
+        matchers[chall_id] = None
+    unknown_challs.clear()
+    flag_owners.clear()
+
+
+def flag_changed(msg: bus.Message) -> None:
+    global flag_changes
+    flag_changes += 1
+    unknown_challs.discard(msg.data["chall_id"])
+    if msg.kind == "chall_delete":
+        matchers.pop(msg.data["chall_id"], None)
+        flag_owners.pop(msg.data["chall_id"], None)
     else:
-        files_dir = None
-        files_dir_name = FILE_STORE_DIR
-
-
-async def cleanup():
-    if isinstance(files_dir, tempfile.TemporaryDirectory):
-        await files_dir.cleanup()  # type: ignore
+        matchers[msg.data["chall_id"]] = None
+
+
+def team_changed(msg: bus.Message) -> None:
+    global team_changes
+    team_changes += 1
+    team_id = msg.data["team_id"]
+    for chall_id, owners in flag_owners.items():
+        if msg.kind == "team_create":
+            owners[team_token(chall_id, team_id)] = team_id
+        else:
+            owners.pop(team_token(chall_id, team_id), None)
+
+
+async def get_flag_owners(chall_id: int) -> dict[str, int]:
+    if (owners := flag_owners.get(chall_id)) is not None:
+        return owners
+    seen_changes = team_changes
+    async with session_scope() as session:
+        team_ids = (await session.scalars(select(TeamDB.id))).all()
+    owners = {team_token(chall_id, team_id): team_id for team_id in team_ids}
+    if seen_changes == team_changes:
+        flag_owners[chall_id] = owners
+    return owners
+
+
+@dataclass(slots=True)
+class FileEntry:
+    chall_id: int
+    name: str
+    path: str  # sha256 of the content, which is also its name in the store
+    stat: os.stat_result | None = None
+
+
+# Files by id, so downloads don't need the database. Their content never
+# changes, so the stat is cached too. A file this worker missed the creation
+# of is looked up on its first download.
+file_index: dict[int, FileEntry] = {}
+# File ids looked up and not found
+unknown_files: set[int] = set()
+UNKNOWN_FILES_MAX = 10000
+# Bumped on every change, so a reload racing one is done again
+file_changes = 0
+
+
+async def load_files() -> None:
+    for kind in ("file_create", "file_delete", "chall_delete"):
+        bus.subscribe(kind, file_changed)
+    bus.on_resync(reload_files)
+    await reload_files()
+
+
+async def reload_files() -> None:
+    while True:
+        seen_changes = file_changes
+        async with session_scope() as session:
+            files = {
+                file.id: FileEntry(file.chall_id, file.name, file.path)
+                for file in await session.scalars(select(FileDB))
+            }
+        if seen_changes == file_changes:
+            break
+    file_index.clear()
+    file_index.update(files)
+    unknown_files.clear()
+
+
+def file_changed(msg: bus.Message) -> None:
+    global file_changes
+    file_changes += 1
+    if msg.kind == "file_create":
+        unknown_files.discard(msg.data["file_id"])
+        file_index[msg.data["file_id"]] = FileEntry(
+            msg.data["chall_id"], msg.data["name"], msg.data["path"]
+        )
+    elif msg.kind == "file_delete":
+        file_index.pop(msg.data["file_id"], None)
+    else:
+        for file_id in [
+            file_id
+            for file_id, file in file_index.items()
+            if file.chall_id == msg.data["chall_id"]
+        ]:
+            del file_index[file_id]
 
 
 async def create_chall(chall: ChallReg) -> None:
-    async with session_genr() as session:
-        async with session.begin():
-            session.add(
-                ChallDB(
-                    name=chall.name,
-                    desc=chall.desc,
-                    flag=chall.flag,
-                    points=chall.points,
-                )
+    """
+    Raises ValueError if the flag can't be used as its kind.
+    """
+    check_flag(chall.flag_kind, chall.flag)
+    async with session_scope() as session:
+        async with transaction(session):
+            chall_obj = ChallDB(
+                name=chall.name,
+                desc=chall.desc,
+                flag=chall.flag,
+                flag_kind=chall.flag_kind,
+                initial_points=chall.points,
+                min_points=chall.min_points,
+                decay=chall.decay,
+                decay_func=chall.decay_func,
+                solved_cnt=0,
             )
+            rescore(chall_obj)
+            session.add(chall_obj)
+    await bus.publish("chall_create", **chall_data(chall_obj))
 
 
 async def update_chall(chall_id: int, details: ChallUpdate) -> bool:
-    async with session_genr() as session:
+    async with session_scope() as session:
         try:
-            async with session.begin():
-                chall = await session.get(ChallDB, chall_id)
+            async with transaction(session):
+                chall = await session.get(
+                    ChallDB, chall_id, with_for_update=True, populate_existing=True
+                )
                 if not chall:
                     raise NoResultFound
                 if details.name:
@@ -72,122 +239,290 @@ async def update_chall(chall_id: int, details: ChallUpdate) -> bool:
                     chall.desc = details.desc
                 if details.flag:
                     chall.flag = details.flag
+                if details.flag_kind:
+                    chall.flag_kind = details.flag_kind
+                check_flag(FlagKind(chall.flag_kind), chall.flag)
                 if details.points:
-                    chall.points = details.points
+                    chall.initial_points = details.points
+                if details.min_points is not None:
+                    chall.min_points = details.min_points
+                if details.decay is not None:
+                    chall.decay = details.decay
+                if details.decay_func:
+                    chall.decay_func = details.decay_func
+                rescore(chall)
         except IntegrityError:
             return False
+    await bus.publish("chall_update", **chall_data(chall))
     return True
 
 
-async def create_file(chall_id: int, file: UploadFile) -> bool:
-    name = file.filename
-    sha256 = hashlib.sha256()
-    async with aiofiles.tempfile.NamedTemporaryFile(
-        dir=files_dir_name, suffix=".tmp", delete=False
-    ) as out:
-        tmp_name = out.name
-        while True:
-            data = await file.read(FILE_BUFF_SIZE)
-            if not data:
-                break
-            sha256.update(data)
-            await out.write(data)
-    digest = sha256.hexdigest()
-    try:
-        os.rename(str(tmp_name), os.path.join(files_dir_name, digest))
-    except OSError:
-        # The file already exists, no issues!
-        print("rename failed")  # remove after testing
-        pass
-    async with session_genr() as session:
+async def create_file(
+    chall_id: int, name: str, chunks: AsyncIterator[bytes]
+) -> bool:
+    """
+    Stores a file streamed as `chunks`. Raises blobstore.TooLarge past
+    FILE_MAX_SIZE.
+    """
+    async with session_scope() as session:
+        if not await session.get(ChallDB, chall_id):
+            return False
+        # Not holding a pooled connection through the upload
+        await release(session)
+    digest = await blobstore.store(chunks, FILE_MAX_SIZE)
+    async with session_scope() as session:
         try:
-            async with session.begin():
-                session.add(FileDB(name=name, path=digest, chall_id=chall_id))
+            async with transaction(session):
+                file = FileDB(name=name, path=digest, chall_id=chall_id)
+                session.add(file)
         except IntegrityError:
             return False
+    await bus.publish(
+        "file_create", chall_id=chall_id, file_id=file.id, name=name, path=digest
+    )
     return True
 
 
-async def verify_flag(chall_id: int, flag: str) -> bool:
-    async with session_genr() as session:
-        chall = await session.get(ChallDB, chall_id)
-        if not chall:
-            return False
-        real_flag = chall.flag
-        if real_flag != flag:
+async def verify_flag(chall_id: int, team_id: int, flag: str) -> bool:
+    if chall_id in unknown_challs:
+        return False
+    if (matcher := matchers.get(chall_id)) is None:
+        seen_changes = flag_changes
+        async with session_scope() as session:
+            chall_flags = (await accepted_flags(session, chall_id)).get(chall_id)
+        if not chall_flags:
+            if seen_changes == flag_changes:
+                if len(unknown_challs) >= UNKNOWN_CHALLS_MAX:
+                    unknown_challs.clear()
+                unknown_challs.add(chall_id)
             return False
+        matcher = Matcher(chall_id, chall_flags)
+        if seen_changes == flag_changes:
+            matchers[chall_id] = matcher
+    if matcher(flag, team_id):
+        return True
+    if tokens := matcher.tokens(flag):
+        owners = await get_flag_owners(chall_id)
+        for token in tokens:
+            if (owner := owners.get(token)) is not None and owner != team_id:
+                logging.warning(
+                    "Team %d submitted the flag of team %d for challenge %d",
+                    team_id,
+                    owner,
+                    chall_id,
+                )
+    return False
+
+
+async def create_flag(chall_id: int, details: FlagReg) -> bool:
+    """
+    Raises ValueError if the flag can't be used as its kind.
+    """
+    check_flag(details.kind, details.flag)
+    async with session_scope() as session:
+        async with transaction(session):
+            if not await session.get(ChallDB, chall_id):
+                return False
+            session.add(FlagDB(chall_id=chall_id, kind=details.kind, flag=details.flag))
+    await bus.publish("flag_create", chall_id=chall_id)
     return True
 
 
-async def create_solve(user_id: int, chall_id: int) -> bool:
-    async with session_genr() as session:
-        try:
-            async with session.begin():
-                if not (user := await session.get(UserDB, user_id)):
-                    raise RuntimeError("Logged user not there")
-                session.add(
-                    SolveDB(
-                        user_id=user_id,
-                        team_id=(await user.awaitable_attrs.team).id,
-                        chall_id=chall_id,
-                        time=datetime.now(),
-                    )
+async def delete_flag(chall_id: int, flag_id: int) -> None:
+    async with session_scope() as session:
+        async with transaction(session):
+            flag = await session.get(FlagDB, flag_id)
+            if not flag or flag.chall_id != chall_id:
+                raise NoResultFound
+            await session.delete(flag)
+    await bus.publish("flag_delete", chall_id=chall_id)
+
+
+async def get_team_flags(chall_id: int, team_id: int) -> TeamFlags:
+    """
+    The personalized flags of a team for a challenge, to be handed to it.
+    """
+    async with session_scope() as session:
+        if not await session.get(TeamDB, team_id):
+            raise NoResultFound
+        chall_flags = (await accepted_flags(session, chall_id)).get(chall_id)
+    if chall_flags is None:
+        raise NoResultFound
+    return TeamFlags(
+        flags=[
+            team_flag(prefix, chall_id, team_id)
+            for kind, prefix in chall_flags
+            if kind == FlagKind.team
+        ]
+    )
+
+
+async def get_chall_flags(chall_id: int) -> ChallFlags:
+    async with session_scope() as session:
+        if not await session.get(ChallDB, chall_id):
+            raise NoResultFound
+        return ChallFlags(
+            flags=[
+                FlagForChall(id=flag.id, flag=flag.flag, kind=FlagKind(flag.kind))
+                for flag in await session.scalars(
+                    select(FlagDB).filter_by(chall_id=chall_id).order_by(FlagDB.id)
                 )
-        except IntegrityError:
-            return False
+            ]
+        )
+
+
+def chall_data(chall: ChallDB) -> dict:
+    return {
+        "chall_id": chall.id,
+        "name": chall.name,
+        "initial_points": chall.initial_points,
+        "min_points": chall.min_points,
+        "decay": chall.decay,
+        "decay_func": chall.decay_func,
+    }
+
+
+def rescore(chall: ChallDB) -> None:
+    chall.points = chall_value(
+        Decay(chall.decay_func),
+        chall.initial_points,
+        chall.min_points,
+        chall.decay,
+        chall.solved_cnt,
+    )
+
+
+async def create_solve(user_id: int, team_id: int, chall_id: int) -> bool:
+    """
+    Records a solve by the user for their team. False if the team already
+    solved the challenge or it doesn't exist.
+    """
+    solve = SolveDB(
+        user_id=user_id, team_id=team_id, chall_id=chall_id, time=datetime.now()
+    )
+    async with session_scope() as session:
+        async with transaction(session):
+            # Row lock serializes solves of this challenge, keeping the
+            # counter and the decayed value consistent. Taken before the
+            # insert, whose foreign key check would share-lock it otherwise.
+            chall = await session.get(
+                ChallDB, chall_id, with_for_update=True, populate_existing=True
+            )
+            if not chall:
+                return False
+            # A duplicate is skipped by the unique constraint, not raised
+            result = await session.execute(
+                insert(SolveDB)
+                .prefix_with("IGNORE")
+                .values(
+                    user_id=solve.user_id,
+                    team_id=solve.team_id,
+                    chall_id=solve.chall_id,
+                    time=solve.time,
+                )
+            )
+            if not result.rowcount:
+                return False
+            prev_points = chall.points
+            chall.solved_cnt += 1
+            rescore(chall)
+    await bus.publish_many(solve_messages(solve, chall, prev_points))
     return True
 
 
-async def delete_file(file_id: int):
-    async with session_genr() as session:
+def solve_messages(
+    solve: SolveDB, chall: ChallDB, prev_points: int
+) -> list[tuple[str, dict]]:
+    messages = [
+        (
+            "solve",
+            {
+                "user_id": solve.user_id,
+                "team_id": solve.team_id,
+                "chall_id": solve.chall_id,
+                "time": solve.time.timestamp(),
+            },
+        ),
+        # The solving team gains the challenge's value, and with decay every
+        # earlier solver of it changes by `solvers_delta`
+        (
+            "score",
+            {
+                "team_id": solve.team_id,
+                "chall_id": solve.chall_id,
+                "points": chall.points,
+                "solvers_delta": chall.points - prev_points,
+            },
+        ),
+    ]
+    if chall.solved_cnt == 1:
+        messages.append(
+            (
+                "first_blood",
+                {
+                    "user_id": solve.user_id,
+                    "team_id": solve.team_id,
+                    "chall_id": solve.chall_id,
+                },
+            )
+        )
+    return messages
+
+
+async def uncount_solves(session: AsyncSession, chall_ids: list[int]) -> None:
+    if not chall_ids:
+        return
+    challs = (
+        await session.scalars(
+            select(ChallDB)
+            .where(ChallDB.id.in_(chall_ids))
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+    ).all()
+    for chall in challs:
+        chall.solved_cnt -= 1
+        rescore(chall)
+
+
+async def delete_file(chall_id: int, file_id: int):
+    async with session_scope() as session:
         try:
-            async with session.begin():
+            async with transaction(session):
                 file = await session.get(FileDB, file_id)
-                if not file:
+                if not file or file.chall_id != chall_id:
                     raise NoResultFound
-                try:
-                    os.unlink(os.path.join(files_dir_name, file.path))
-                except FileNotFoundError:
-                    pass
                 await session.delete(file)
         except IntegrityError:
             return False
+    await blobstore.release([file.path])
+    await bus.publish("file_delete", chall_id=chall_id, file_id=file_id)
     return True
 
 
 async def delete_chall(chall_id: int):
-    async with session_genr() as session:
+    async with session_scope() as session:
         try:
-            async with session.begin():
+            async with transaction(session):
                 chall = await session.get(ChallDB, chall_id)
                 if not chall:
                     raise NoResultFound
+                digests = []
                 for file in await chall.awaitable_attrs.files:
+                    digests.append(file.path)
                     await session.delete(file)
+                for flag in await chall.awaitable_attrs.extra_flags:
+                    await session.delete(flag)
                 for solve in await chall.awaitable_attrs.solves:
                     await session.delete(solve)
                 await session.delete(chall)
         except IntegrityError:
             return False
+    await blobstore.release(digests)
+    await bus.publish("chall_delete", chall_id=chall_id)
     return True
 
 
-async def get_chall_solves_from_obj(chall: ChallDB) -> ChallSolves:
-    return ChallSolves(
-        solves=[
-            SolveForChall(
-                team=TeamForSolveForChall(
-                    id=(await solve.awaitable_attrs.team).id,
-                    name=(await solve.awaitable_attrs.team).name,
-                ),
-                points=chall.points,
-                time=solve.time,
-            )
-            for solve in await chall.awaitable_attrs.solves
-        ]
-    )
-
-
 async def get_chall_files(chall: ChallDB) -> list[FileForChall]:
     return [
         FileForChall(id=file.id, name=file.name)
@@ -206,43 +541,106 @@ async def get_chall_from_obj(chall: ChallDB) -> Chall:
         # to prevent exposing the flag solution.
         flag_hash=None,
         # -----------------------------------------------------------------
-        solved_cnt=len(await chall.awaitable_attrs.solves),
+        solved_cnt=chall.solved_cnt,
         files=await get_chall_files(chall),
     )
 
 
-async def get_chall_solves(chall_id: int) -> ChallSolves:
-    async with session_genr() as session:
+async def get_chall_solves(
+    chall_id: int, limit: int | None, after: str | None = None
+) -> ChallSolves:
+    """
+    Solves of a challenge in time order, `limit` at a time (all if None) from
+    the cursor `after`. Raises ValueError if the cursor is malformed.
+    """
+    # Solves are keyed by (time, id)
+    key = cursor.decode(after, ((float, int), int)) if after else None
+    async with session_scope() as session:
         chall = await session.get(ChallDB, chall_id)
         if not chall:
             raise NoResultFound
-        return await get_chall_solves_from_obj(chall)
+        stmt = (
+            select(SolveDB.id, SolveDB.time, TeamDB.id.label("team_id"), TeamDB.name)
+            .join(TeamDB, TeamDB.id == SolveDB.team_id)
+            .where(SolveDB.chall_id == chall_id)
+            .order_by(SolveDB.time, SolveDB.id)
+            .limit(cursor.fetch_size(limit))
+        )
+        if key:
+            time, solve_id = datetime.fromtimestamp(key[0]), key[1]
+            stmt = stmt.where(
+                or_(
+                    SolveDB.time > time,
+                    and_(SolveDB.time == time, SolveDB.id > solve_id),
+                )
+            )
+        rows = (await session.execute(stmt)).all()
+    return ChallSolves(
+        solves=[
+            SolveForChall(
+                team=TeamForSolveForChall(id=row.team_id, name=row.name),
+                points=chall.points,
+                time=row.time,
+            )
+            for row in rows[:limit]
+        ],
+        next=(
+            cursor.encode((rows[limit - 1].time.timestamp(), rows[limit - 1].id))
+            if cursor.has_next(rows, limit)
+            else None
+        ),
+    )
 
 
 async def get_chall(chall_id: int) -> Chall:
-    async with session_genr() as session:
-        chall = await session.get(ChallDB, chall_id)
+    async with session_scope() as session:
+        chall = await session.get(
+            ChallDB, chall_id, options=[selectinload(ChallDB.files)]
+        )
         if not chall:
             raise NoResultFound
         return await get_chall_from_obj(chall)
 
 
 async def get_chall_list() -> ChallList:
-    async with session_genr() as session:
+    async with session_scope() as session:
         return ChallList(
             challs=[
                 await get_chall_from_obj(chall)
-                for chall in await session.scalars(select(ChallDB))
+                for chall in await session.scalars(
+                    select(ChallDB).options(selectinload(ChallDB.files))
+                )
             ]
         )
 
 
-async def get_file(file_id: int) -> FileResponse | Literal[False]:
-    async with session_genr() as session:
-        file = await session.get(FileDB, file_id)
-        if not file:
+async def lookup_file(file_id: int) -> FileEntry | None:
+    if file_id in unknown_files:
+        return None
+    seen_changes = file_changes
+    async with session_scope() as session:
+        row = await session.get(FileDB, file_id)
+    file = FileEntry(row.chall_id, row.name, row.path) if row else None
+    if seen_changes == file_changes:
+        if file:
+            file_index[file_id] = file
+        else:
+            if len(unknown_files) >= UNKNOWN_FILES_MAX:
+                unknown_files.clear()
+            unknown_files.add(file_id)
+    return file
+
+
+async def get_file(
+    chall_id: int, file_id: int, accept_encoding: str = ""
+) -> Response | Literal[False]:
+    file = file_index.get(file_id) or await lookup_file(file_id)
+    if not file or file.chall_id != chall_id:
+        return False
+    path = blobstore.path(file.path)
+    if not file.stat:
+        try:
+            file.stat = await asyncio.to_thread(os.stat, path)
+        except FileNotFoundError:
             return False
-        print(os.path.join(files_dir_name, file.path), file.name)
-        return FileResponse(
-            path=os.path.join(files_dir_name, file.path), filename=file.name
-        )
+    return delivery.file_response(file.path, file.name, file.stat, accept_encoding)
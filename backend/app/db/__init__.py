@@ -1,6 +1,13 @@
 import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    create_async_engine,
+    async_sessionmaker,
+)
 
 from app.config import DB_HOST, DB_PORT, DB_USER, DB_PASSWD, DB_NAME
 from app.db.models import Base
@@ -18,6 +25,63 @@ engine = create_async_engine(
 # Don't depend on stale data while updating anything in DB
 session_genr = async_sessionmaker(bind=engine, expire_on_commit=False)
 
+# Session of the current request, shared by auth and every service function
+# it calls, so a request holds one pooled connection and one identity map
+current_session: ContextVar[AsyncSession | None] = ContextVar(
+    "current_session", default=None
+)
+
+
+async def request_session() -> AsyncIterator[AsyncSession]:
+    """
+    FastAPI dependency opening the request's session.
+    """
+    async with session_genr() as session:
+        token = current_session.set(session)
+        try:
+            yield session
+        finally:
+            current_session.reset(token)
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    The request's session, or a new one outside of a request.
+    """
+    session = current_session.get()
+    if session:
+        yield session
+        return
+    async with session_genr() as session:
+        yield session
+
+
+@asynccontextmanager
+async def transaction(session: AsyncSession) -> AsyncIterator[None]:
+    """
+    Commits on success and rolls back on an exception, like session.begin().
+    """
+    if session is not current_session.get():
+        async with session.begin():
+            yield
+        return
+    # The request's session may already be in a transaction from earlier
+    # reads, and its objects are still in use; a savepoint rolls back (and
+    # expires) only what this block changed
+    async with session.begin_nested():
+        yield
+    await session.commit()
+
+
+async def release(session: AsyncSession) -> None:
+    """
+    Ends the session's transaction so its connection goes back to the pool
+    before a long wait. Loaded objects stay usable.
+    """
+    if session.in_transaction():
+        await session.commit()
+
 
 async def init():
     async with engine.begin() as conn:
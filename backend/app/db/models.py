@@ -3,10 +3,10 @@ from datetime import datetime
 
 from sqlalchemy import String, Boolean, UniqueConstraint, ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
-from sqlalchemy.dialects.mysql import CHAR
 from sqlalchemy.ext.asyncio import AsyncAttrs
 
-from app.utils import hashing
+from app.utils.scoring import Decay
+from app.utils.flagmatch import FlagKind
 import app.config as c
 
 
@@ -14,14 +14,16 @@ class Base(AsyncAttrs, DeclarativeBase):
     pass
 
 
-HASH_LEN = len(hashing.hash("."))
+# Hash lengths vary with the scheme and its costs, which can change while
+# older hashes are still around
+HASH_MAX_LEN = 128
 
 
 class ExpToken(Base):
-    __tablename__ = "expired_tokens"
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    token: Mapped[str] = mapped_column(String(c.TOKEN_MAX_LEN))
-    __table_args__ = (UniqueConstraint("token", name="exptoken_token_uniq"),)
+    # Revoked tokens by their jti claim, kept until the token expires anyway
+    __tablename__ = "revoked_tokens"
+    jti: Mapped[str] = mapped_column(String(32), primary_key=True)
+    exp: Mapped[datetime] = mapped_column(index=True)
 
 
 class User(Base):
@@ -31,9 +33,7 @@ class User(Base):
     email: Mapped[str] = mapped_column(String(c.EMAIL_ADDR_MAX_LEN))
     admin: Mapped[bool] = mapped_column(Boolean)
     email_verified: Mapped[bool] = mapped_column(Boolean)
-    pass_hash: Mapped[str] = mapped_column(
-        String(HASH_LEN).with_variant(CHAR(HASH_LEN), "mysql", "mariadb")
-    )
+    pass_hash: Mapped[str] = mapped_column(String(HASH_MAX_LEN))
     team_id: Mapped[int | None] = mapped_column(ForeignKey("teams.id"))
     team: Mapped[Optional["Team"]] = relationship(back_populates="users")
     solves: Mapped[list["Solve"]] = relationship(back_populates="user")
@@ -47,9 +47,7 @@ class Team(Base):
     __tablename__ = "teams"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(c.TEAM_NAME_MAX_LEN))
-    pass_hash: Mapped[str] = mapped_column(
-        String(HASH_LEN).with_variant(CHAR(HASH_LEN), "mysql", "mariadb")
-    )
+    pass_hash: Mapped[str] = mapped_column(String(HASH_MAX_LEN))
     users: Mapped[list["User"]] = relationship(back_populates="team")
     solves: Mapped[list["Solve"]] = relationship(back_populates="team")
     __table_args__ = (UniqueConstraint("name", name="team_name_uniq"),)
@@ -61,9 +59,31 @@ class Chall(Base):
     name: Mapped[str] = mapped_column(String(c.CHAL_NAME_MAX_LEN))
     desc: Mapped[str] = mapped_column(String(c.CHAL_DESC_MAX_LEN))
     flag: Mapped[str] = mapped_column(String(c.FLAG_MAX_LEN))
+    flag_kind: Mapped[str] = mapped_column(
+        String(16), default=FlagKind.exact.value, server_default=FlagKind.exact.value
+    )
+    # Current value, recomputed from the fields below as solves come in
     points: Mapped[int] = mapped_column()
+    initial_points: Mapped[int] = mapped_column()
+    min_points: Mapped[int] = mapped_column(default=0, server_default="0")
+    decay: Mapped[int] = mapped_column(default=0, server_default="0")
+    decay_func: Mapped[str] = mapped_column(
+        String(16), default=Decay.static.value, server_default=Decay.static.value
+    )
+    solved_cnt: Mapped[int] = mapped_column(default=0, server_default="0")
     files: Mapped[list["File"]] = relationship(back_populates="chall")
     solves: Mapped[list["Solve"]] = relationship(back_populates="chall")
+    extra_flags: Mapped[list["Flag"]] = relationship(back_populates="chall")
+
+
+class Flag(Base):
+    # Accepted flags besides Chall.flag
+    __tablename__ = "flags"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    chall_id: Mapped[int] = mapped_column(ForeignKey("challenges.id"))
+    kind: Mapped[str] = mapped_column(String(16))
+    flag: Mapped[str] = mapped_column(String(c.FLAG_MAX_LEN))
+    chall: Mapped["Chall"] = relationship(back_populates="extra_flags")
 
 
 class File(Base):
@@ -90,6 +110,20 @@ class Solve(Base):
     )
 
 
+class Submission(Base):
+    # Every flag submission, see app.submissions. No foreign keys, the log
+    # outlives deleted users, teams and challenges.
+    __tablename__ = "submissions"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column()
+    team_id: Mapped[int] = mapped_column()
+    chall_id: Mapped[int] = mapped_column()
+    correct: Mapped[bool] = mapped_column(Boolean)
+    flag_hash: Mapped[str] = mapped_column(String(64))  # sha256, hex
+    time: Mapped[datetime] = mapped_column()
+    ip: Mapped[str] = mapped_column(String(45))
+
+
 class Notification(Base):
     __tablename__ = "notifications"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
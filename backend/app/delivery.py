@@ -0,0 +1,291 @@
+import asyncio
+import gzip
+import logging
+import mimetypes
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from time import time
+from urllib.parse import quote
+
+from fastapi import Response
+from fastapi.responses import FileResponse
+
+from app import bus, blobstore
+from app.config import (
+    FILE_DELIVERY,
+    FILE_ACCEL_PREFIX,
+    FILE_COMPRESS,
+    FILE_COMPRESS_MIN_SIZE,
+    FILE_COMPRESS_MAX_SIZE,
+    FILE_COMPRESS_THREADS,
+    FILE_BUFF_SIZE,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# How challenge files leave the server. "direct" streams them from Python,
+# "x-accel" (nginx) and "x-sendfile" (Apache, lighttpd) only send headers and
+# leave the file to the front server's sendfile. Compressible files also get
+# zstd and gzip variants, made in the background on their first download and
+# kept next to the blob. The worker that makes one claims it with its temp
+# file, so a crowd fetching the same file at the start of an event costs one
+# compression whichever workers they reach, on at most FILE_COMPRESS_THREADS
+# threads per worker.
+
+# Kept only if at most this much of the original
+MAX_RATIO = 0.9
+# Fast enough for files of hundreds of MiB, most of the gain of the top levels
+ZSTD_LEVEL = 6
+GZIP_LEVEL = 6
+# A claim whose temp file hasn't changed for this long (in seconds) was left
+# by a worker that died at it
+CLAIM_TIMEOUT = 60
+# How long (in seconds) to wait before looking again at a variant claimed by
+# another worker
+CLAIM_RETRY = 10
+INCOMPRESSIBLE_TYPES = (
+    "image/",
+    "video/",
+    "audio/",
+    "application/zip",
+    "application/gzip",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-rar-compressed",
+    "application/zstd",
+    "application/pdf",
+)
+
+
+@dataclass(slots=True)
+class Metrics:
+    served: int = 0
+    offloaded: int = 0  # left to the front server
+    compressed: int = 0  # served as a variant
+    variants_made: int = 0
+    variants_skipped: int = 0  # didn't compress well enough
+    variant_errors: int = 0
+
+
+def gzip_file(src: str, dst) -> None:
+    with (
+        open(src, "rb") as i,
+        gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as o,
+    ):
+        shutil.copyfileobj(i, o, FILE_BUFF_SIZE)
+
+
+def zstd_file(src: str, dst) -> None:
+    with open(src, "rb") as i:
+        zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(i, dst)
+
+
+# Best first
+ENCODERS = {"zstd": zstd_file} if zstandard else {}
+ENCODERS["gzip"] = gzip_file
+
+metrics = Metrics()
+# Stat of the variants made, None for those not worth keeping, by (digest,
+# encoding)
+variants: dict[tuple[str, str], os.stat_result | None] = {}
+compressing: set[tuple[str, str]] = set()
+tasks: set[asyncio.Task] = set()
+executor: ThreadPoolExecutor | None = None
+
+
+def init() -> None:
+    global executor
+    executor = ThreadPoolExecutor(FILE_COMPRESS_THREADS, thread_name_prefix="compress")
+    bus.subscribe("file_create", file_created)
+    bus.on_resync(forget_variants)
+
+
+async def forget_variants() -> None:
+    # Looked up again on disk on their next download
+    variants.clear()
+
+
+def close() -> None:
+    for task in tasks:
+        task.cancel()
+    if executor:
+        # A compression under way is left to finish, its claim then goes
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def file_created(msg: bus.Message) -> None:
+    # Content coming back after its blob was released, with its variants
+    for encoding in ENCODERS:
+        variants.pop((msg.data["path"], encoding), None)
+
+
+def compressible(name: str, size: int) -> bool:
+    if not FILE_COMPRESS or not FILE_COMPRESS_MIN_SIZE <= size <= FILE_COMPRESS_MAX_SIZE:
+        return False
+    media_type, encoding = mimetypes.guess_type(name)
+    if encoding:  # .tar.gz and the like
+        return False
+    return not (media_type and media_type.startswith(INCOMPRESSIBLE_TYPES))
+
+
+def negotiate(accept_encoding: str) -> list[str]:
+    """
+    Encodings with a variant that the client takes, best first.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        accepted[coding.strip().lower()] = q
+    return [e for e in ENCODERS if accepted.get(e, accepted.get("*", 0)) > 0]
+
+
+def claim(tmp_path: str) -> int:
+    """
+    Creates the temp file of a variant and returns its descriptor. Raises
+    FileExistsError while another worker is making it.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        return os.open(tmp_path, flags, 0o644)
+    except FileExistsError:
+        try:
+            if os.stat(tmp_path).st_mtime > time() - CLAIM_TIMEOUT:
+                raise
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            # Just finished
+            raise FileExistsError(tmp_path)
+    return os.open(tmp_path, flags, 0o644)
+
+
+def kept(stat: os.stat_result) -> os.stat_result | None:
+    # Variants not worth keeping are left empty, so no worker makes them again
+    return stat if stat.st_size else None
+
+
+def make_variant(digest: str, encoding: str) -> os.stat_result | None:
+    """
+    Raises FileExistsError while another worker is making it.
+    """
+    target = blobstore.variant_path(digest, encoding)
+    try:
+        # Made by another worker or before a restart
+        return kept(os.stat(target))
+    except FileNotFoundError:
+        pass
+    src = blobstore.path(digest)
+    tmp_path = target + blobstore.TMP_SUFFIX
+    fd = claim(tmp_path)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            ENCODERS[encoding](src, out)
+            if out.tell() > os.stat(src).st_size * MAX_RATIO:
+                out.seek(0)
+                out.truncate()
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return kept(os.stat(target))
+
+
+async def compress(digest: str, encoding: str) -> None:
+    key = (digest, encoding)
+    try:
+        variants[key] = stat = await asyncio.get_running_loop().run_in_executor(
+            executor, make_variant, digest, encoding
+        )
+    except FileExistsError:
+        # Another worker is at it, this one looks again after a while
+        await asyncio.sleep(CLAIM_RETRY)
+    except Exception:
+        logging.exception("Compressing %s with %s failed", digest, encoding)
+        metrics.variant_errors += 1
+        variants[key] = None
+    else:
+        if stat:
+            metrics.variants_made += 1
+        else:
+            metrics.variants_skipped += 1
+    finally:
+        compressing.discard(key)
+
+
+def variant(digest: str, encoding: str) -> os.stat_result | None:
+    """
+    The stat of the variant if there is one. Otherwise it is made in the
+    background and the file is sent as is meanwhile.
+    """
+    key = (digest, encoding)
+    if key in variants:
+        return variants[key]
+    if key not in compressing:
+        compressing.add(key)
+        task = asyncio.create_task(compress(digest, encoding))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    return None
+
+
+def content_disposition(name: str) -> str:
+    quoted = quote(name)
+    if quoted != name:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{name}"'
+
+
+def file_response(
+    digest: str, name: str, stat: os.stat_result, accept_encoding: str
+) -> Response:
+    """
+    The response sending the blob of `digest` as `name`. Its ETag is the
+    digest, with the encoding for a variant.
+    """
+    metrics.served += 1
+    path = blobstore.path(digest)
+    headers = {"ETag": f'"{digest}"'}
+    if compressible(name, stat.st_size):
+        headers["Vary"] = "Accept-Encoding"
+        for encoding in negotiate(accept_encoding):
+            if variant_stat := variant(digest, encoding):
+                path = blobstore.variant_path(digest, encoding)
+                stat = variant_stat
+                headers["ETag"] = f'"{digest}-{encoding}"'
+                headers["Content-Encoding"] = encoding
+                metrics.compressed += 1
+                break
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if FILE_DELIVERY == "direct":
+        # Range and If-Range are handled by FileResponse, against the ETag
+        return FileResponse(
+            path=path,
+            filename=name,
+            stat_result=stat,
+            headers=headers,
+            media_type=media_type,
+        )
+    metrics.offloaded += 1
+    headers["Content-Disposition"] = content_disposition(name)
+    if FILE_DELIVERY == "x-accel":
+        headers["X-Accel-Redirect"] = FILE_ACCEL_PREFIX + os.path.basename(path)
+    else:
+        headers["X-Sendfile"] = os.path.abspath(path)
+    return Response(headers=headers, media_type=media_type)
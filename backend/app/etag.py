@@ -0,0 +1,112 @@
+from collections import defaultdict
+
+from fastapi import HTTPException, Request, Response, status
+
+from app import bus
+
+# Data versions behind the ETags of the public read endpoints. A version is
+# the bus sequence number of the last message that changed its scope, so it
+# only grows and is the same on every worker. Versions are bumped after the
+# write has committed, so a tag is never newer than the data it is sent with.
+
+SCOPES = {
+    "chall_create": ("challs", "teams", "users"),
+    "chall_update": ("challs", "teams", "users"),
+    "chall_delete": ("challs", "teams", "users"),
+    "file_create": ("challs",),
+    "file_delete": ("challs",),
+    "solve": ("challs", "teams", "users"),
+    "team_create": ("teams", "users"),
+    "team_update": ("teams", "users", "solves"),
+    "team_delete": ("challs", "teams", "users", "solves"),
+    "team_join": ("users",),
+    "team_leave": ("challs", "teams", "users", "solves"),
+    "user_create": ("users",),
+    "user_update": ("users",),
+    "user_delete": ("challs", "teams", "users", "solves"),
+    "notification_create": ("notifications",),
+    "notification_update": ("notifications",),
+    "notification_delete": ("notifications",),
+}
+# Messages that change the solves of a single challenge
+CHALL_KINDS = ("solve", "chall_update", "chall_delete")
+
+versions: dict[str, int] = defaultdict(int)
+chall_versions: dict[int, int] = {}
+base = 0
+# Changes applied while Redis was unreachable have no sequence number, they
+# count here instead and change every tag of this worker
+local_changes = 0
+
+
+def init() -> None:
+    global base, local_changes
+    # Nothing before the bus position at start is known, so start from there
+    base = bus.last_seq
+    versions.clear()
+    chall_versions.clear()
+    local_changes = 0
+    for kind in SCOPES:
+        bus.subscribe(kind, bump)
+    bus.on_resync(resync)
+
+
+async def resync() -> None:
+    # Which scopes missed changes is unknown, so every tag changes
+    global local_changes
+    local_changes += 1
+
+
+def bump(msg: bus.Message) -> None:
+    global local_changes
+    if msg.seq is None:
+        local_changes += 1
+        return
+    # Versions never go back, even for a message older than one already seen
+    for scope in SCOPES[msg.kind]:
+        versions[scope] = max(versions[scope], msg.seq)
+    if msg.kind in CHALL_KINDS:
+        chall_id = msg.data["chall_id"]
+        chall_versions[chall_id] = max(chall_versions.get(chall_id, 0), msg.seq)
+
+
+def version(scope: str) -> int:
+    return max(versions[scope], base)
+
+
+def make_tag(*parts) -> str:
+    if local_changes:
+        parts += (f"l{local_changes}",)
+    return '"' + "-".join(map(str, parts)) + '"'
+
+
+def check(
+    request: Request, response: Response, tag: str, cache_control: str = "no-cache"
+) -> None:
+    """
+    Ends the request with a 304 if the client already has `tag`, otherwise
+    sends it along with the response.
+    """
+    headers = {"ETag": tag, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        if tag in tags or "*" in tags:
+            raise HTTPException(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+            )
+    response.headers.update(headers)
+
+
+def conditional(scope: str):
+    def dependency(request: Request, response: Response) -> None:
+        check(request, response, make_tag(scope, version(scope)))
+
+    return dependency
+
+
+def conditional_chall_solves(
+    chall_id: int, request: Request, response: Response
+) -> None:
+    v = max(version("solves"), chall_versions.get(chall_id, 0))
+    check(request, response, make_tag("solves", chall_id, v))
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import signal
+from collections import deque
+from dataclasses import dataclass
+from time import monotonic
+from typing import AsyncIterator
+
+from app import bus
+from app.config import (
+    EVENT_BUFFER_SIZE,
+    EVENT_QUEUE_SIZE,
+    EVENT_KEEPALIVE,
+    EVENT_STREAM_MAX_AGE,
+)
+
+# Live event feed for the /events/stream SSE endpoint, fed from the bus so
+# every worker streams the same events under the same ids (the bus sequence
+# numbers). Recent events are kept in a ring buffer so reconnecting clients
+# can resume with Last-Event-ID. The server waits for open responses before
+# shutting down, so streams end when it is told to exit, and after
+# EVENT_STREAM_MAX_AGE in case that signal never reaches them.
+
+KINDS = (
+    "solve",
+    "score",
+    "first_blood",
+    "notification_create",
+    "notification_update",
+    "notification_delete",
+)
+
+
+@dataclass(slots=True)
+class Event:
+    id: int | None  # None for bus messages applied without Redis
+    type: str
+    data: dict
+
+    def encode(self) -> bytes:
+        data = json.dumps(self.data)
+        id_line = f"id: {self.id}\n" if self.id is not None else ""
+        return f"{id_line}event: {self.type}\ndata: {data}\n\n".encode()
+
+
+RESET = b"event: reset\ndata: {}\n\n"
+KEEPALIVE = b": keepalive\n\n"
+
+buffer: deque[Event] = deque(maxlen=EVENT_BUFFER_SIZE)
+# A None in a queue tells its stream to end
+subscribers: set[asyncio.Queue[Event | None]] = set()
+last_id = 0
+# Id of the newest event no longer in the buffer; ids are sparse, so this is
+# what tells whether a client can still be caught up
+dropped_id = 0
+
+
+def init() -> None:
+    global last_id, dropped_id
+    # Anything before the bus position at start was never buffered here
+    last_id = dropped_id = bus.last_seq
+    for kind in KINDS:
+        bus.subscribe(kind, forward)
+    bus.on_resync(reset)
+
+
+async def reset() -> None:
+    # Missed events can't be sent, clients refetch everything instead
+    global dropped_id
+    buffer.clear()
+    dropped_id = last_id
+    publish("reset", {}, None)
+
+
+def forward(msg: bus.Message) -> None:
+    publish(msg.kind, msg.data, msg.seq)
+
+
+def publish(type: str, data: dict, id: int | None) -> Event:
+    global last_id, dropped_id
+    event = Event(id=id, type=type, data=data)
+    # Without an id it can't be resumed from, so it is only sent live
+    if id is not None:
+        last_id = max(last_id, id)
+        if len(buffer) == buffer.maxlen:
+            dropped_id = buffer[0].id
+        buffer.append(event)
+    for queue in subscribers:
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow client, drop it; it can resume from the buffer
+            queue.get_nowait()
+            queue.put_nowait(None)
+    return event
+
+
+def since(last_event_id: int) -> list[Event] | None:
+    """
+    Events after `last_event_id`, or None if the buffer no longer reaches
+    back that far (or the id is from before a restart).
+    """
+    if last_event_id == last_id:
+        return []
+    if last_event_id > last_id or last_event_id < dropped_id:
+        return None
+    return [event for event in buffer if event.id > last_event_id]
+
+
+async def stream(last_event_id: int | None = None) -> AsyncIterator[bytes]:
+    queue: asyncio.Queue[Event | None] = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    # Subscribe before replaying so nothing published meanwhile is missed
+    subscribers.add(queue)
+    end = monotonic() + EVENT_STREAM_MAX_AGE
+    try:
+        sent = last_id
+        if last_event_id is not None:
+            missed = since(last_event_id)
+            if missed is None:
+                # Too far behind, the client has to refetch everything
+                yield RESET
+            else:
+                for event in missed:
+                    yield event.encode()
+        while (left := end - monotonic()) > 0:
+            try:
+                event = await asyncio.wait_for(queue.get(), min(EVENT_KEEPALIVE, left))
+            except TimeoutError:
+                yield KEEPALIVE
+                continue
+            if event is None:
+                return
+            if event.id is not None:
+                if event.id <= sent:
+                    continue
+                sent = event.id
+            yield event.encode()
+    finally:
+        subscribers.discard(queue)
+
+
+def close_on_exit() -> None:
+    """
+    Ends the streams on the first SIGINT or SIGTERM, ahead of the server's
+    own handler, which then waits for them to close.
+    """
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(close)
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+
+def close() -> None:
+    for queue in subscribers:
+        try:
+            queue.put_nowait(None)
+        except asyncio.QueueFull:
+            queue.get_nowait()
+            queue.put_nowait(None)
@@ -0,0 +1,174 @@
+import logging
+import math
+import secrets
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Annotated
+
+import redis.asyncio as redis
+from fastapi import Depends, HTTPException, status
+
+from app.auth import verify_token
+from app.db.models import User as UserDB
+from app.config import RATE_LIMIT_LOCAL_KEYS
+
+# Rate limits keyed by team and user rather than IP, which NAT makes both
+# too coarse and too easy to spread. Windows slide and live in Redis, shared
+# by all workers. Each worker first runs a token bucket of the same rate per
+# key, and remembers keys Redis turned away until their wait is over, so a
+# flood is rejected without a round-trip. Without Redis only that local
+# check applies.
+
+KEY_PREFIX = "flagged:rl:"
+
+# KEYS are the windows to count the request in, ARGV their (limit, window
+# in ms) pairs followed by a unique member. The request is counted in all of
+# them or none; returns per key how many ms until it has room, 0 if it had.
+SLIDING_WINDOW_LUA = """
+local time = redis.call('TIME')
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local waits = {}
+local full = false
+for i, key in ipairs(KEYS) do
+    local limit, window = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    waits[i] = 0
+    if redis.call('ZCARD', key) >= limit then
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        waits[i] = math.max(tonumber(oldest[2]) + window - now, 1)
+        full = true
+    end
+end
+if not full then
+    for i, key in ipairs(KEYS) do
+        redis.call('ZADD', key, now, ARGV[#ARGV])
+        redis.call('PEXPIRE', key, ARGV[2 * i])
+    end
+end
+return waits
+"""
+
+
+@dataclass(slots=True)
+class Bucket:
+    tokens: float
+    updated: float
+    blocked_until: float = 0
+
+
+@dataclass(slots=True)
+class Metrics:
+    allowed: int = 0
+    rejected_local: int = 0
+    rejected_redis: int = 0
+    redis_errors: int = 0
+
+
+metrics = Metrics()
+buckets: OrderedDict[str, Bucket] = OrderedDict()
+window_script = None
+
+
+def init(redis_conn: redis.Redis) -> None:
+    global window_script
+    window_script = redis_conn.register_script(SLIDING_WINDOW_LUA)
+
+
+def bucket(key: str, times: int, seconds: int, now: float) -> Bucket:
+    entry = buckets.get(key)
+    if not entry:
+        entry = buckets[key] = Bucket(tokens=times, updated=now)
+        while len(buckets) > RATE_LIMIT_LOCAL_KEYS:
+            buckets.popitem(last=False)
+    else:
+        refill = (now - entry.updated) * times / seconds
+        entry.tokens = min(times, entry.tokens + refill)
+        entry.updated = now
+        buckets.move_to_end(key)
+    return entry
+
+
+def check_local(rules: list[tuple[str, int, int]], now: float) -> float:
+    """
+    Seconds to wait if a rule's local bucket is out, else takes a token from
+    each and returns 0.
+    """
+    entries = [bucket(key, times, seconds, now) for key, times, seconds in rules]
+    wait = 0.0
+    for entry, (_, times, seconds) in zip(entries, rules):
+        wait = max(
+            wait,
+            entry.blocked_until - now,
+            (1 - entry.tokens) * seconds / times,
+        )
+    if wait > 0:
+        return wait
+    for entry in entries:
+        entry.tokens -= 1
+    return 0
+
+
+async def check_redis(rules: list[tuple[str, int, int]], now: float) -> float:
+    """
+    Seconds to wait if a window is full, else counts the request and
+    returns 0. Fails open if Redis can't be reached.
+    """
+    if not window_script:
+        return 0
+    args = []
+    for _, times, seconds in rules:
+        args += [times, seconds * 1000]
+    try:
+        waits = await window_script(
+            keys=[KEY_PREFIX + key for key, _, _ in rules],
+            args=args + [secrets.token_hex(8)],
+        )
+    except Exception:
+        logging.exception("Rate limiting through Redis failed")
+        metrics.redis_errors += 1
+        return 0
+    for (key, _, _), wait in zip(rules, waits):
+        if wait and (entry := buckets.get(key)):
+            entry.blocked_until = now + wait / 1000
+    return max(waits) / 1000
+
+
+class RateLimit:
+    """
+    Dependency limiting a route to `per_team` and `per_user` requests, each
+    given as (requests, window in seconds). Users without a team only count
+    against their own limit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        per_team: tuple[int, int] | None = None,
+        per_user: tuple[int, int] | None = None,
+    ):
+        self.name = name
+        self.per_team = per_team
+        self.per_user = per_user
+
+    async def __call__(self, user: Annotated[UserDB, Depends(verify_token)]) -> None:
+        rules = []
+        if self.per_team and user.team:
+            rules.append((f"{self.name}:team:{user.team.id}", *self.per_team))
+        if self.per_user:
+            rules.append((f"{self.name}:user:{user.id}", *self.per_user))
+        if not rules:
+            return
+        now = monotonic()
+        if wait := check_local(rules, now):
+            metrics.rejected_local += 1
+        elif wait := await check_redis(rules, now):
+            metrics.rejected_redis += 1
+        else:
+            metrics.allowed += 1
+            return
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
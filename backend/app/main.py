@@ -1,17 +1,34 @@
 from contextlib import asynccontextmanager
 import logging
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import redis.asyncio as redis
 from fastapi_limiter import FastAPILimiter
 
-from app.routers import service, auth, user, team, chall, notification
+from app.routers import service, auth, user, team, chall, notification, events
+from app.db import request_session
+from app.utils.hashing import Overloaded
+from app.config import HASH_RETRY_AFTER
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    from app import db, chall, user
+    from app import (
+        db,
+        chall,
+        user,
+        scoreboard,
+        events,
+        bus,
+        etag,
+        auth,
+        submissions,
+        limiter,
+        blobstore,
+        delivery,
+    )
 
     # --- New: Initialize Redis and FastAPILimiter ---
     logging.info("Connecting to Redis...")
@@ -22,10 +39,26 @@ async def lifespan(app: FastAPI):
     # ------------------------------------------------
 
     logging.basicConfig()
-    await chall.init()
+    await blobstore.init()
     await db.init()
+    await bus.init(redis_connection)
+    limiter.init(redis_connection)
+    await chall.load_flags()
+    await chall.load_files()
+    delivery.init()
+    await scoreboard.init()
+    events.init()
+    events.close_on_exit()
+    etag.init()
+    await auth.init()
+    submissions.init()
     await user.create_admin()
     yield
+    events.close()
+    await auth.close()
+    await submissions.close()
+    delivery.close()
+    await bus.close()
 
     # --- New: Close FastAPILimiter connection (optional but good practice) ---
     await FastAPILimiter.close()
@@ -33,10 +66,20 @@ async def lifespan(app: FastAPI):
     # -----------------------------------------------------------------------
 
     await db.engine.dispose()
-    await chall.cleanup()
+    await blobstore.cleanup()
 
 
-app = FastAPI(lifespan=lifespan)
+# Every request gets one DB session, see app.db.request_session
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(request_session)])
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server busy, try again later"},
+        headers={"Retry-After": str(HASH_RETRY_AFTER)},
+    )
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -53,3 +96,4 @@ app.include_router(user.router)
 app.include_router(team.router)
 app.include_router(chall.router)
 app.include_router(notification.router)
+app.include_router(events.router)
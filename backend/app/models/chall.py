@@ -4,13 +4,19 @@ from datetime import datetime
 from pydantic import BaseModel, StringConstraints
 
 from app.config import CHAL_NAME_MAX_LEN, CHAL_DESC_MAX_LEN, FLAG_MAX_LEN
+from app.utils.scoring import Decay
+from app.utils.flagmatch import FlagKind
 
 
 class ChallReg(BaseModel):
     name: Annotated[str, StringConstraints(min_length=1, max_length=CHAL_NAME_MAX_LEN)]
     desc: Annotated[str | None, StringConstraints(max_length=CHAL_DESC_MAX_LEN)]
     flag: Annotated[str, StringConstraints(min_length=1, max_length=FLAG_MAX_LEN)]
+    flag_kind: FlagKind = FlagKind.exact
     points: int
+    decay_func: Decay = Decay.static
+    min_points: int = 0
+    decay: int = 0
 
 
 class ChallUpdate(BaseModel):
@@ -21,7 +27,30 @@ class ChallUpdate(BaseModel):
     flag: Annotated[
         str | None, StringConstraints(min_length=1, max_length=FLAG_MAX_LEN)
     ]
+    flag_kind: FlagKind | None = None
     points: int | None
+    decay_func: Decay | None = None
+    min_points: int | None = None
+    decay: int | None = None
+
+
+class FlagReg(BaseModel):
+    flag: Annotated[str, StringConstraints(min_length=1, max_length=FLAG_MAX_LEN)]
+    kind: FlagKind = FlagKind.exact
+
+
+class FlagForChall(BaseModel):
+    id: int
+    flag: str
+    kind: FlagKind
+
+
+class ChallFlags(BaseModel):
+    flags: list[FlagForChall]
+
+
+class TeamFlags(BaseModel):
+    flags: list[str]
 
 
 class TeamForSolveForChall(BaseModel):
@@ -37,6 +66,7 @@ class SolveForChall(BaseModel):
 
 class ChallSolves(BaseModel):
     solves: list[SolveForChall]
+    next: str | None = None  # cursor of the next page
 
 
 class FileForChall(BaseModel):
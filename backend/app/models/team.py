@@ -1,4 +1,5 @@
 from typing import Annotated
+from datetime import datetime
 
 from pydantic import BaseModel, StringConstraints
 
@@ -33,6 +34,7 @@ class TeamPubForList(BaseModel):
 
 class TeamPubList(BaseModel):
     teams: list[TeamPubForList]
+    next: str | None = None  # cursor of the next page
 
 
 class ChallForTeamPub(BaseModel):
@@ -54,3 +56,15 @@ class TeamPub(TeamPubForList):
 
 class Team(TeamPub):
     pass
+
+
+class TeamSeries(BaseModel):
+    id: int
+    name: str
+    points: list[int]
+
+
+class TeamGraph(BaseModel):
+    start: datetime
+    bucket: int  # in seconds
+    teams: list[TeamSeries]
@@ -44,6 +44,7 @@ class UserPubForList(BaseModel):
 
 class UserPubList(BaseModel):
     users: list[UserPubForList]
+    next: str | None = None  # cursor of the next page
 
 
 class ChallForUserPub(BaseModel):
@@ -1,7 +1,8 @@
 from sqlalchemy import select
 from sqlalchemy.exc import NoResultFound
 
-from app.db import session_genr
+from app import bus
+from app.db import session_scope, transaction
 from app.db.models import Notification as NotificationDB
 from app.models.notification import NotificationReg, NotificationUpdate, Notification
 
@@ -10,22 +11,28 @@ async def create_notification(notification: NotificationReg) -> None:
     """
     Creates a new notification and adds it to the database.
     """
-    async with session_genr() as session:
-        async with session.begin():
-            session.add(
-                NotificationDB(
-                    title=notification.title,
-                    content=notification.content,
-                    timestamp=notification.timestamp,
-                )
+    async with session_scope() as session:
+        async with transaction(session):
+            notification_obj = NotificationDB(
+                title=notification.title,
+                content=notification.content,
+                timestamp=notification.timestamp,
             )
+            session.add(notification_obj)
+    await bus.publish(
+        "notification_create",
+        id=notification_obj.id,
+        title=notification_obj.title,
+        content=notification_obj.content,
+        timestamp=notification_obj.timestamp,
+    )
 
 
 async def get_all_notifications() -> list[Notification]:
     """
     Retrieves all notifications from the database.
     """
-    async with session_genr() as session:
+    async with session_scope() as session:
         result = await session.execute(
             select(NotificationDB).order_by(NotificationDB.timestamp.desc())
         )
@@ -44,8 +51,8 @@ async def update_notification(
     """
     Updates a notification in the database.
     """
-    async with session_genr() as session:
-        async with session.begin():
+    async with session_scope() as session:
+        async with transaction(session):
             notification = await session.get(NotificationDB, notification_id)
             if not notification:
                 raise NoResultFound
@@ -54,6 +61,13 @@ async def update_notification(
                 notification.title = details.title
             if details.content is not None:
                 notification.content = details.content
+    await bus.publish(
+        "notification_update",
+        id=notification.id,
+        title=notification.title,
+        content=notification.content,
+        timestamp=notification.timestamp,
+    )
     return True
 
 
@@ -61,9 +75,10 @@ async def delete_notification(notification_id: int) -> None:
     """
     Deletes a notification from the database.
     """
-    async with session_genr() as session:
-        async with session.begin():
+    async with session_scope() as session:
+        async with transaction(session):
             notification = await session.get(NotificationDB, notification_id)
             if not notification:
                 raise NoResultFound
             await session.delete(notification)
+    await bus.publish("notification_delete", id=notification_id)
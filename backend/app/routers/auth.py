@@ -1,11 +1,13 @@
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi_limiter.depends import RateLimiter
 
-from app.auth import bearer_passwd, bearer_passwd_form
+from app.auth import bearer_passwd, bearer_passwd_form, username_identifier
 from app.db.models import User as UserDB
 from app.models.auth import TokenResp, ExpireResp
 from app.auth import verify_user_passwd, gen_token, verify_token, expire_token
+from app.config import LOGIN_LIMIT_PER_IP, LOGIN_LIMIT_PER_USERNAME
 
 router = APIRouter(
     prefix="/auth",
@@ -13,7 +15,19 @@ router = APIRouter(
 )
 
 
-@router.post("/login")
+@router.post(
+    "/login",
+    dependencies=[
+        Depends(RateLimiter(times=LOGIN_LIMIT_PER_IP, minutes=1)),
+        Depends(
+            RateLimiter(
+                times=LOGIN_LIMIT_PER_USERNAME,
+                minutes=1,
+                identifier=username_identifier,
+            )
+        ),
+    ],
+)
 async def login_user(
     form: Annotated[bearer_passwd_form, Depends()],
 ) -> TokenResp:
@@ -1,22 +1,41 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    status,
+)
 from pydantic import BaseModel, StringConstraints
 from sqlalchemy.exc import NoResultFound
 
-# --- New Imports for Rate Limiting ---
-from fastapi_limiter.depends import RateLimiter
-# ------------------------------------
-
 import app.db.models as db
-from app.models.chall import ChallReg, ChallUpdate, ChallSolves, Chall, ChallList
+from app import etag, submissions, blobstore
+from app.models.chall import (
+    ChallReg,
+    ChallUpdate,
+    ChallSolves,
+    Chall,
+    ChallList,
+    FlagReg,
+    ChallFlags,
+    TeamFlags,
+)
 from app.auth import verify_token
+from app.utils.upload import MultipartFile
+from app.limiter import RateLimit
 from app.chall import (
     create_chall,
     update_chall,
     create_file,
     create_solve,
     verify_flag,
+    create_flag,
+    delete_flag,
+    get_chall_flags,
+    get_team_flags,
     delete_chall,
     delete_file,
     get_chall,
@@ -24,7 +43,15 @@ from app.chall import (
     get_chall_solves,
     get_file,
 )
-from app.config import FILE_NAME_MAX_LEN, FLAG_MAX_LEN
+from app.config import (
+    FILE_NAME_MAX_LEN,
+    FILE_CACHE_CONTROL,
+    FILE_MAX_SIZE,
+    FLAG_MAX_LEN,
+    PAGE_MAX_SIZE,
+    SOLVE_LIMIT_PER_TEAM,
+    SOLVE_LIMIT_PER_USER,
+)
 
 # --- New Pydantic model for secure flag submission ---
 class FlagSubmission(BaseModel):
@@ -47,7 +74,12 @@ async def add_chall(user: Annotated[db.User, Depends(verify_token)], chall: Chal
         )
     if not chall.desc:
         chall.desc = ""
-    await create_chall(chall)
+    try:
+        await create_chall(chall)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
     return {"message": "Challenge created"}
 
 
@@ -67,6 +99,10 @@ async def change_chall_details(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Challenge not found",
         )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
     return {"message": "Challenge updated"}
 
 
@@ -87,23 +123,129 @@ async def remove_chall(user: Annotated[db.User, Depends(verify_token)], chall_id
     return {"message": "Challenge deleted"}
 
 
+@router.get("/{chall_id}/flags")
+async def get_flags_of_chall(
+    user: Annotated[db.User, Depends(verify_token)], chall_id: int
+) -> ChallFlags:
+    if not user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User unauthorized for this action",
+        )
+    try:
+        return await get_chall_flags(chall_id)
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Challenge not found",
+        )
+
+
+@router.get("/{chall_id}/flags/team/{team_id}")
+async def get_team_flags_of_chall(
+    user: Annotated[db.User, Depends(verify_token)], chall_id: int, team_id: int
+) -> TeamFlags:
+    if not user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User unauthorized for this action",
+        )
+    try:
+        return await get_team_flags(chall_id, team_id)
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Challenge/Team not found",
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+
+
+@router.post("/{chall_id}/flag/add")
+async def add_flag(
+    user: Annotated[db.User, Depends(verify_token)], chall_id: int, flag: FlagReg
+):
+    if not user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User unauthorized for this action",
+        )
+    try:
+        if not await create_flag(chall_id, flag):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Challenge not found",
+            )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+    return {"message": "Flag added"}
+
+
+@router.post("/{chall_id}/flag/{flag_id}/delete")
+async def remove_flag(
+    user: Annotated[db.User, Depends(verify_token)], chall_id: int, flag_id: int
+):
+    if not user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User unauthorized for this action",
+        )
+    try:
+        await delete_flag(chall_id, flag_id)
+    except NoResultFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Challenge/Flag not found",
+        )
+    return {"message": "Flag deleted"}
+
+
 @router.post("/{chall_id}/file/add")
 async def add_file(
     chall_id: int,
     user: Annotated[db.User, Depends(verify_token)],
-    file: UploadFile,
+    request: Request,
 ):
-    if not file.filename or len(file.filename) > FILE_NAME_MAX_LEN:
+    # The body is streamed to the store, not parsed into an UploadFile first
+    if not user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User unauthorized for this action",
+        )
+    # Leaves room for the multipart framing around the file
+    if int(request.headers.get("content-length", 0)) > FILE_MAX_SIZE + 65536:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="File too large",
+        )
+    try:
+        upload = MultipartFile(request, "file")
+        filename = await upload.open()
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
+        )
+    if not filename or len(filename) > FILE_NAME_MAX_LEN:
         raise HTTPException(
             status_code=status.HTTP_418_IM_A_TEAPOT,
             detail="Too long/no filename",
         )
-    if not user.admin:
+    try:
+        created = await create_file(chall_id, filename, upload.read())
+    except blobstore.TooLarge:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User unauthorized for this action",
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="File too large",
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e)
         )
-    if not await create_file(chall_id, file):
+    if not created:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Challenge associated with chall_id not found",
@@ -121,7 +263,7 @@ async def remove_file(
             detail="User unauthorized for this action",
         )
     try:
-        await delete_file(file_id)
+        await delete_file(chall_id, file_id)
     except NoResultFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -131,20 +273,31 @@ async def remove_file(
 
 
 @router.get("/{chall_id}/file/{file_id}")
-async def get_file_of_chall(chall_id: int, file_id: int):
-    resp = await get_file(file_id)
+async def get_file_of_chall(chall_id: int, file_id: int, request: Request):
+    resp = await get_file(
+        chall_id, file_id, request.headers.get("accept-encoding", "")
+    )
     if not resp:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="File not found"
         )
+    # The content under a file id never changes, the ETag is its digest
+    # (and encoding)
+    etag.check(request, resp, resp.headers["etag"], FILE_CACHE_CONTROL)
     return resp
 
 
 @router.post(
     "/{chall_id}/solve",
-    # --- New: Add server-side rate limiting dependency ---
-    dependencies=[Depends(RateLimiter(times=5, seconds=60))],
-    # ----------------------------------------------------
+    dependencies=[
+        Depends(
+            RateLimit(
+                "solve",
+                per_team=SOLVE_LIMIT_PER_TEAM,
+                per_user=SOLVE_LIMIT_PER_USER,
+            )
+        )
+    ],
 )
 async def add_solve(
     user: Annotated[db.User, Depends(verify_token)],
@@ -152,6 +305,7 @@ async def add_solve(
     # --- Changed: Take the flag from the request body as a Pydantic model ---
     submission: FlagSubmission,
     # -----------------------------------------------------------------------
+    request: Request,
 ):
     if not user.team:
         raise HTTPException(
@@ -160,14 +314,23 @@ async def add_solve(
         )
     
     # --- Changed: Use the flag from the submission model ---
-    if not await verify_flag(chall_id, submission.flag):
+    correct = await verify_flag(chall_id, user.team.id, submission.flag)
+    submissions.record(
+        user.id,
+        user.team.id,
+        chall_id,
+        correct,
+        submission.flag,
+        request.client.host if request.client else "",
+    )
+    if not correct:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Flag does not match for challenge",
         )
     # -----------------------------------------------------
 
-    if not await create_solve(user.id, chall_id):
+    if not await create_solve(user.id, user.team.id, chall_id):
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Already solved",
@@ -175,7 +338,7 @@ async def add_solve(
     return {"message": "Challenge solved"}
 
 
-@router.get("/")
+@router.get("/", dependencies=[Depends(etag.conditional("challs"))])
 async def get_list_of_challs() -> ChallList:
     return await get_chall_list()
 
@@ -190,11 +353,22 @@ async def get_chall_details(chall_id: int) -> Chall:
         )
 
 
-@router.get("/{chall_id}/solves")
-async def get_solves_of_chall(chall_id: int) -> ChallSolves:
+@router.get(
+    "/{chall_id}/solves", dependencies=[Depends(etag.conditional_chall_solves)]
+)
+async def get_solves_of_chall(
+    chall_id: int,
+    # Without a limit everything is returned, for clients that don't page
+    limit: Annotated[int | None, Query(ge=1, le=PAGE_MAX_SIZE)] = None,
+    after: str | None = None,
+) -> ChallSolves:
     try:
-        return await get_chall_solves(chall_id)
+        return await get_chall_solves(chall_id, limit, after)
     except NoResultFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Challenge not found"
         )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
@@ -0,0 +1,22 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Header
+from fastapi.responses import StreamingResponse
+
+from app import events
+
+router = APIRouter(
+    prefix="/events",
+    tags=["events"],
+)
+
+
+@router.get("/stream")
+async def stream_events(
+    last_event_id: Annotated[int | None, Header()] = None,
+) -> StreamingResponse:
+    return StreamingResponse(
+        events.stream(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
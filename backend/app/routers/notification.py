@@ -5,6 +5,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.exc import NoResultFound
 
 import app.db.models as db
+from app import etag
 from app.models.notification import (
     NotificationReg,
     NotificationUpdate,
@@ -44,7 +45,7 @@ async def add_notification(
     return {"message": "Notification created"}
 
 
-@router.get("/")
+@router.get("/", dependencies=[Depends(etag.conditional("notifications"))])
 async def get_notifications() -> NotificationList:
     """
     Endpoint to fetch all notifications.
@@ -1,9 +1,13 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends
+from dataclasses import asdict
 
+from fastapi import APIRouter, Depends, HTTPException, status
+
+from app import submissions, limiter, blobstore, delivery
 from app.auth import verify_token
 from app.db.models import User as UserDB
+from app.utils import hashing
 
 router = APIRouter(
     prefix="/service",
@@ -19,3 +23,19 @@ async def hello():
 @router.get("/hello_user")
 async def hello_user(user: Annotated[UserDB, Depends(verify_token)]):
     return {"message": f"Hello {user.username}"}
+
+
+@router.get("/metrics")
+async def get_metrics(user: Annotated[UserDB, Depends(verify_token)]):
+    if not user.admin:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User unauthorized for this action",
+        )
+    return {
+        "hashing": asdict(hashing.metrics),
+        "submissions": asdict(submissions.metrics),
+        "rate_limits": asdict(limiter.metrics),
+        "uploads": asdict(blobstore.metrics),
+        "downloads": asdict(delivery.metrics),
+    }
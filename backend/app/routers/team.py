@@ -1,11 +1,21 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi_limiter.depends import RateLimiter
 from sqlalchemy.exc import NoResultFound
 
-from app.models.team import TeamReg, TeamUpdate, TeamJoinReq, Team, TeamPub, TeamPubList
+from app.models.team import (
+    TeamReg,
+    TeamUpdate,
+    TeamJoinReq,
+    Team,
+    TeamPub,
+    TeamPubList,
+    TeamGraph,
+)
 from app.db.models import User as UserDB
-from app.auth import verify_token
+from app import etag
+from app.auth import verify_token, team_name_identifier
 from app.team import (
     create_team,
     delete_team,
@@ -14,8 +24,15 @@ from app.team import (
     get_team_pub,
     get_team_pub_list,
     get_team,
+    get_team_graph,
     update_team,
 )
+from app.config import (
+    GRAPH_MAX_TEAMS,
+    PAGE_MAX_SIZE,
+    TEAM_JOIN_LIMIT_PER_IP,
+    TEAM_JOIN_LIMIT_PER_TEAM,
+)
 
 router = APIRouter(
     prefix="/team",
@@ -98,7 +115,19 @@ async def delete_other_team(user: Annotated[UserDB, Depends(verify_token)], team
     return {"message": "Team deleted"}
 
 
-@router.put("/join")
+@router.put(
+    "/join",
+    dependencies=[
+        Depends(RateLimiter(times=TEAM_JOIN_LIMIT_PER_IP, minutes=1)),
+        Depends(
+            RateLimiter(
+                times=TEAM_JOIN_LIMIT_PER_TEAM,
+                minutes=1,
+                identifier=team_name_identifier,
+            )
+        ),
+    ],
+)
 async def join_team(user: Annotated[UserDB, Depends(verify_token)], team: TeamJoinReq):
     try:
         if not await add_user_to_team(user.id, team):
@@ -149,6 +178,15 @@ async def get_logged_user_team_details(
     return await get_team(user.team.id)
 
 
+@router.get("s/graph")
+async def get_score_graph(
+    top: Annotated[int, Query(ge=1, le=GRAPH_MAX_TEAMS)] = 10,
+    bucket: Annotated[str, Query(pattern=r"^[1-9]\d*[smh]?$")] = "60s",
+) -> TeamGraph:
+    secs = int(bucket.rstrip("smh")) * {"m": 60, "h": 3600}.get(bucket[-1], 1)
+    return await get_team_graph(top, secs)
+
+
 @router.get("s/{team_id}")
 async def get_other_team_details(team_id: int) -> TeamPub:
     try:
@@ -160,6 +198,15 @@ async def get_other_team_details(team_id: int) -> TeamPub:
         )
 
 
-@router.get("s")
-async def get_team_list() -> TeamPubList:
-    return await get_team_pub_list()
+@router.get("s", dependencies=[Depends(etag.conditional("teams"))])
+async def get_team_list(
+    # Without a limit everything is returned, for clients that don't page
+    limit: Annotated[int | None, Query(ge=1, le=PAGE_MAX_SIZE)] = None,
+    after: str | None = None,
+) -> TeamPubList:
+    try:
+        return await get_team_pub_list(limit, after)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
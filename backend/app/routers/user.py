@@ -1,17 +1,14 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Query, status, BackgroundTasks
 from fastapi.responses import RedirectResponse
+from fastapi_limiter.depends import RateLimiter
 from sqlalchemy.exc import NoResultFound
-from typing import AsyncGenerator
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.db import session_genr
+from app.db import session_scope, request_session
 from app.db.models import User as UserDB
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.future import select
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async with session_genr() as session:
-        yield session
 
 from app.models.user import (
     UserReg,
@@ -23,6 +20,7 @@ from app.models.user import (
     UserPubList,
 )
 from app.db.models import User as UserDB
+from app import etag
 from app.auth import verify_token
 from app.user import (
     create_user,
@@ -34,7 +32,12 @@ from app.user import (
     verify_user_email_token,
 )
 from app.utils.email_utils import send_verification_email
-from app.config import FRONTEND_BASE_URL, VERIFY_USER_EMAIL
+from app.config import (
+    FRONTEND_BASE_URL,
+    VERIFY_USER_EMAIL,
+    PAGE_MAX_SIZE,
+    REGISTER_LIMIT_PER_IP,
+)
 from app.utils.email_utils import send_forgot_password_email 
 router = APIRouter(
     prefix="/user",
@@ -47,7 +50,7 @@ class ForgotPasswordRequest(BaseModel):
 async def send_forgot_password(
     request: ForgotPasswordRequest,
     bg_tasks: BackgroundTasks,
-    session=Depends(get_session)
+    session: Annotated[AsyncSession, Depends(request_session)],
 ):
     # Check if the email exists in the database
     result = await session.execute(
@@ -67,7 +70,11 @@ async def send_forgot_password(
     return {"message": "Password reset email has been sent."}
 
 
-@router.post("/add", status_code=status.HTTP_201_CREATED)
+@router.post(
+    "/add",
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[Depends(RateLimiter(times=REGISTER_LIMIT_PER_IP, minutes=1))],
+)
 async def add_user(user: UserReg, bg_tasks: BackgroundTasks) -> UserRegResp:
     if await create_user(user):
         return UserRegResp(message="User registered")
@@ -186,9 +193,18 @@ async def get_other_user_details(user_id: int) -> UserPub:
         )
 
 
-@router.get("s")
-async def get_user_list() -> UserPubList:
-    return await get_user_pub_list()
+@router.get("s", dependencies=[Depends(etag.conditional("users"))])
+async def get_user_list(
+    # Without a limit everything is returned, for clients that don't page
+    limit: Annotated[int | None, Query(ge=1, le=PAGE_MAX_SIZE)] = None,
+    after: str | None = None,
+) -> UserPubList:
+    try:
+        return await get_user_pub_list(limit, after)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
 from pydantic import BaseModel, EmailStr
 
 class ResetPasswordRequest(BaseModel):
@@ -198,7 +214,7 @@ class ResetPasswordRequest(BaseModel):
 
 @router.put("/reset-password")
 async def reset_password(request: ResetPasswordRequest):
-    async with session_genr() as session:
+    async with session_scope() as session:
         result = await session.execute(
             select(UserDB).where(
                 UserDB.username == request.username,
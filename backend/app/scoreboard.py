@@ -0,0 +1,422 @@
+import math
+from bisect import bisect_right
+from time import time
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import select
+
+from app import bus
+from app.db import session_genr
+from app.db.models import (
+    User as UserDB,
+    Team as TeamDB,
+    Chall as ChallDB,
+    Solve as SolveDB,
+)
+from app.models.team import TeamPubList, TeamPubForList, TeamGraph, TeamSeries
+from app.models.user import UserPubList, UserPubForList
+from app.utils import cursor
+from app.utils.scoring import Decay, chall_value
+from app.config import SCOREBOARD_CACHE, GRAPH_MAX_POINTS
+
+# In-memory scoreboard, loaded once on start and then kept in sync through
+# the bus, on every worker. Messages that come in while the snapshot loads are
+# held back and applied on top of it; some of them may already be in it, so
+# the handlers tolerate being replayed. With SCOREBOARD_CACHE disabled it is
+# neither loaded nor updated.
+
+
+@dataclass(slots=True)
+class ChallEntry:
+    id: int
+    name: str
+    initial_points: int
+    min_points: int
+    decay: int
+    decay_func: str
+    points: int = 0
+    # team_id -> user_id of the solver
+    solvers: dict[int, int] = field(default_factory=dict)
+
+
+@dataclass(slots=True)
+class TeamEntry:
+    id: int
+    name: str
+    points: int = 0
+    users: set[int] = field(default_factory=set)
+    # Solve history in time order, for the score graph
+    solve_times: array = field(default_factory=lambda: array("d"))
+    solve_challs: array = field(default_factory=lambda: array("q"))
+
+    @property
+    def last_solve(self) -> float:
+        return self.solve_times[-1] if self.solve_times else math.inf
+
+
+@dataclass(slots=True)
+class UserEntry:
+    id: int
+    name: str
+    admin: bool
+    team_id: int | None = None
+    points: int = 0
+    # chall_id -> solve timestamp
+    solves: dict[int, float] = field(default_factory=dict)
+
+    @property
+    def last_solve(self) -> float:
+        return max(self.solves.values(), default=math.inf)
+
+
+challs: dict[int, ChallEntry] = {}
+teams: dict[int, TeamEntry] = {}
+users: dict[int, UserEntry] = {}
+# Sorted (rank keys, entries) of teams and users, rebuilt after any change
+rankings: dict[str, tuple[list[tuple], list]] = {}
+
+
+# Messages held back while a snapshot loads, None otherwise
+pending: list[bus.Message] | None = None
+
+
+async def init():
+    if not SCOREBOARD_CACHE:
+        return
+    # Subscribed first, so nothing published during the load is lost
+    for kind in HANDLERS:
+        bus.subscribe(kind, apply)
+    bus.on_resync(load)
+    await load()
+
+
+async def load() -> None:
+    global pending
+    pending = []
+    try:
+        async with session_genr() as session:
+            chall_rows = (await session.scalars(select(ChallDB))).all()
+            team_rows = (await session.execute(select(TeamDB.id, TeamDB.name))).all()
+            user_rows = (
+                await session.execute(
+                    select(UserDB.id, UserDB.username, UserDB.admin, UserDB.team_id)
+                )
+            ).all()
+            solve_rows = (
+                await session.execute(
+                    select(
+                        SolveDB.user_id, SolveDB.team_id, SolveDB.chall_id, SolveDB.time
+                    ).order_by(SolveDB.time)
+                )
+            ).all()
+    finally:
+        held, pending = pending, None
+    # Rebuilt without awaiting, so readers never see it half done
+    challs.clear()
+    teams.clear()
+    users.clear()
+    for chall in chall_rows:
+        add_chall(
+            chall.id,
+            chall.name,
+            chall.initial_points,
+            chall.min_points,
+            chall.decay,
+            chall.decay_func,
+        )
+    for row in team_rows:
+        add_team(row.id, row.name)
+    for row in user_rows:
+        add_user(row.id, row.username, row.admin)
+        if row.team_id:
+            join_team(row.id, row.team_id)
+    for row in solve_rows:
+        add_solve(
+            row.user_id, row.team_id, row.chall_id, row.time.timestamp(), rescore=False
+        )
+    for chall in challs.values():
+        _rescore(chall)
+    for msg in held:
+        try:
+            HANDLERS[msg.kind](msg)
+        except KeyError:
+            # About something the snapshot already has deleted
+            pass
+    rankings.clear()
+
+
+def apply(msg: bus.Message) -> None:
+    if pending is not None:
+        pending.append(msg)
+        return
+    HANDLERS[msg.kind](msg)
+    rankings.clear()
+
+
+def add_chall(
+    chall_id: int,
+    name: str,
+    initial_points: int,
+    min_points: int,
+    decay: int,
+    decay_func: str,
+) -> None:
+    if chall_id in challs:
+        return
+    chall = ChallEntry(
+        id=chall_id,
+        name=name,
+        initial_points=initial_points,
+        min_points=min_points,
+        decay=decay,
+        decay_func=decay_func,
+    )
+    chall.points = _value(chall)
+    challs[chall_id] = chall
+
+
+def update_chall(
+    chall_id: int,
+    name: str,
+    initial_points: int,
+    min_points: int,
+    decay: int,
+    decay_func: str,
+) -> None:
+    chall = challs[chall_id]
+    chall.name = name
+    chall.initial_points = initial_points
+    chall.min_points = min_points
+    chall.decay = decay
+    chall.decay_func = decay_func
+    _rescore(chall)
+
+
+def remove_chall(chall_id: int) -> None:
+    for team_id in list(challs[chall_id].solvers):
+        _drop_solve(team_id, chall_id, rescore=False)
+    del challs[chall_id]
+
+
+def add_team(team_id: int, name: str, user_id: int | None = None) -> None:
+    if team_id in teams:
+        return
+    teams[team_id] = TeamEntry(id=team_id, name=name)
+    if user_id:
+        join_team(user_id, team_id)
+
+
+def update_team(team_id: int, name: str) -> None:
+    teams[team_id].name = name
+
+
+def remove_team(team_id: int) -> None:
+    team = teams[team_id]
+    for chall_id in list(team.solve_challs):
+        _drop_solve(team_id, chall_id)
+    for user_id in team.users:
+        users[user_id].team_id = None
+    del teams[team_id]
+
+
+def add_user(user_id: int, name: str, admin: bool) -> None:
+    if user_id in users:
+        return
+    users[user_id] = UserEntry(id=user_id, name=name, admin=admin)
+
+
+def update_user(user_id: int, name: str, admin: bool) -> None:
+    user = users[user_id]
+    user.name = name
+    user.admin = admin
+
+
+def remove_user(user_id: int) -> None:
+    unlink_user(user_id)
+    del users[user_id]
+
+
+def join_team(user_id: int, team_id: int) -> None:
+    user = users[user_id]
+    team = teams[team_id]
+    user.team_id = team_id
+    team.users.add(user_id)
+
+
+def unlink_user(user_id: int) -> None:
+    user = users[user_id]
+    if user.team_id is None:
+        return
+    for chall_id in list(user.solves):
+        _drop_solve(user.team_id, chall_id)
+    teams[user.team_id].users.discard(user_id)
+    user.team_id = None
+
+
+def add_solve(
+    user_id: int, team_id: int, chall_id: int, time: float, rescore: bool = True
+) -> None:
+    chall = challs[chall_id]
+    team = teams[team_id]
+    user = users[user_id]
+    # Already counted, or replayed after the solver left the team
+    if team_id in chall.solvers or user.team_id != team_id:
+        return
+    chall.solvers[team_id] = user_id
+    team.solve_times.append(time)
+    team.solve_challs.append(chall_id)
+    team.points += chall.points
+    user.solves[chall_id] = time
+    user.points += chall.points
+    if rescore:
+        _rescore(chall)
+
+
+def _drop_solve(team_id: int, chall_id: int, rescore: bool = True) -> None:
+    chall = challs[chall_id]
+    team = teams[team_id]
+    user = users[chall.solvers.pop(team_id)]
+    i = team.solve_challs.index(chall_id)
+    del team.solve_times[i]
+    del team.solve_challs[i]
+    team.points -= chall.points
+    user.solves.pop(chall_id, None)
+    user.points -= chall.points
+    if rescore:
+        _rescore(chall)
+
+
+def _value(chall: ChallEntry) -> int:
+    return chall_value(
+        Decay(chall.decay_func),
+        chall.initial_points,
+        chall.min_points,
+        chall.decay,
+        len(chall.solvers),
+    )
+
+
+def _rescore(chall: ChallEntry) -> None:
+    # Only the solvers of this challenge are touched, via its solvers index
+    points = _value(chall)
+    if chall.points == points:
+        return
+    delta = points - chall.points
+    chall.points = points
+    for team_id, user_id in chall.solvers.items():
+        teams[team_id].points += delta
+        users[user_id].points += delta
+
+
+HANDLERS = {
+    "chall_create": lambda msg: add_chall(**msg.data),
+    "chall_update": lambda msg: update_chall(**msg.data),
+    "chall_delete": lambda msg: remove_chall(msg.data["chall_id"]),
+    "team_create": lambda msg: add_team(**msg.data),
+    "team_update": lambda msg: update_team(**msg.data),
+    "team_delete": lambda msg: remove_team(msg.data["team_id"]),
+    "team_join": lambda msg: join_team(**msg.data),
+    "team_leave": lambda msg: unlink_user(msg.data["user_id"]),
+    "user_create": lambda msg: add_user(**msg.data),
+    "user_update": lambda msg: update_user(**msg.data),
+    "user_delete": lambda msg: remove_user(msg.data["user_id"]),
+    "solve": lambda msg: add_solve(**msg.data),
+}
+
+
+def rank_key(entry: TeamEntry | UserEntry) -> tuple[int, float, int]:
+    return -entry.points, entry.last_solve, entry.id
+
+
+def ranking(kind: str) -> tuple[list[tuple], list]:
+    if kind not in rankings:
+        if kind == "teams":
+            entries = sorted(teams.values(), key=rank_key)
+        else:
+            entries = sorted(
+                (user for user in users.values() if not user.admin), key=rank_key
+            )
+        rankings[kind] = ([rank_key(entry) for entry in entries], entries)
+    return rankings[kind]
+
+
+def page(
+    kind: str, limit: int | None, after: tuple | None
+) -> tuple[list, str | None]:
+    # Binary search for the cursor, so deep pages cost the same as the first
+    keys, entries = ranking(kind)
+    start = bisect_right(keys, after) if after else 0
+    end = len(keys) if limit is None else start + limit
+    next = cursor.encode_rank(keys[end - 1]) if end < len(keys) else None
+    return entries[start:end], next
+
+
+def get_team_pub_list(limit: int | None, after: tuple | None) -> TeamPubList:
+    entries, next = page("teams", limit, after)
+    return TeamPubList(
+        teams=[
+            TeamPubForList(id=team.id, name=team.name, points=team.points)
+            for team in entries
+        ],
+        next=next,
+    )
+
+
+def get_user_pub_list(limit: int | None, after: tuple | None) -> UserPubList:
+    entries, next = page("users", limit, after)
+    return UserPubList(
+        users=[
+            UserPubForList(
+                id=user.id,
+                name=user.name,
+                team_id=user.team_id,
+                team_name=teams[user.team_id].name if user.team_id else None,
+                points=user.points,
+            )
+            for user in entries
+        ],
+        next=next,
+    )
+
+
+def build_graph(
+    series: list[tuple[int, str, list[tuple[float, int]]]], bucket: int
+) -> TeamGraph:
+    # series: (team_id, name, [(solve timestamp, points), ...] in time order)
+    now = time()
+    start = min((solves[0][0] for _, _, solves in series if solves), default=now)
+    bucket = max(bucket, math.ceil((now - start) / (GRAPH_MAX_POINTS - 1)))
+    cnt = math.floor((now - start) / bucket) + 1
+    teams = []
+    for team_id, name, solves in series:
+        points = []
+        total = i = 0
+        for n in range(cnt):
+            edge = start + n * bucket
+            while i < len(solves) and solves[i][0] <= edge:
+                total += solves[i][1]
+                i += 1
+            points.append(total)
+        teams.append(TeamSeries(id=team_id, name=name, points=points))
+    return TeamGraph(start=datetime.fromtimestamp(start), bucket=bucket, teams=teams)
+
+
+def get_team_graph(top: int, bucket: int) -> TeamGraph:
+    # Only the top teams are walked, and the result has at most
+    # GRAPH_MAX_POINTS points per team however long the event runs
+    return build_graph(
+        [
+            (
+                team.id,
+                team.name,
+                [
+                    (t, challs[chall_id].points)
+                    for t, chall_id in zip(team.solve_times, team.solve_challs)
+                ],
+            )
+            for team in ranking("teams")[1][:top]
+        ],
+        bucket,
+    )
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import insert
+
+from app.db import session_scope, transaction
+from app.db.models import Submission as SubmissionDB
+from app.utils.flagmatch import digest
+from app.config import (
+    SUBMISSION_QUEUE_MAX,
+    SUBMISSION_BATCH_SIZE,
+    SUBMISSION_FLUSH_INTERVAL,
+)
+
+# Log of every flag submission, right or wrong. Requests only queue their
+# row, a single task writes the queue out as multi-row INSERTs every
+# SUBMISSION_FLUSH_INTERVAL or as soon as a batch is full. When the database
+# can't keep up, rows are dropped rather than holding up submissions.
+
+
+@dataclass(slots=True)
+class Metrics:
+    recorded: int = 0
+    dropped: int = 0  # queue full
+    written: int = 0
+    failed: int = 0  # lost to a failed INSERT
+    batches: int = 0
+    queued: int = 0
+    max_queued: int = 0
+    write_time: float = 0  # total, in seconds
+
+
+metrics = Metrics()
+queue: asyncio.Queue[dict] | None = None
+wakeup = asyncio.Event()
+running = False
+flusher: asyncio.Task | None = None
+
+
+def init() -> None:
+    global queue, running, flusher
+    queue = asyncio.Queue(SUBMISSION_QUEUE_MAX)
+    running = True
+    flusher = asyncio.create_task(flush_loop())
+
+
+async def close() -> None:
+    # The flusher drains what is left before it stops
+    global running
+    running = False
+    wakeup.set()
+    if flusher:
+        await flusher
+
+
+def record(
+    user_id: int, team_id: int, chall_id: int, correct: bool, flag: str, ip: str
+) -> None:
+    if not queue:
+        return
+    try:
+        queue.put_nowait(
+            {
+                "user_id": user_id,
+                "team_id": team_id,
+                "chall_id": chall_id,
+                "correct": correct,
+                "flag_hash": digest(flag).hex(),
+                "time": datetime.now(),
+                "ip": ip,
+            }
+        )
+    except asyncio.QueueFull:
+        metrics.dropped += 1
+        return
+    metrics.recorded += 1
+    metrics.queued = queue.qsize()
+    metrics.max_queued = max(metrics.max_queued, metrics.queued)
+    if metrics.queued >= SUBMISSION_BATCH_SIZE:
+        wakeup.set()
+
+
+async def flush_loop() -> None:
+    assert queue
+    while running or not queue.empty():
+        try:
+            await asyncio.wait_for(wakeup.wait(), SUBMISSION_FLUSH_INTERVAL / 1000)
+        except TimeoutError:
+            pass
+        wakeup.clear()
+        while not queue.empty():
+            await write(
+                [
+                    queue.get_nowait()
+                    for _ in range(min(queue.qsize(), SUBMISSION_BATCH_SIZE))
+                ]
+            )
+            metrics.queued = queue.qsize()
+
+
+async def write(rows: list[dict]) -> None:
+    started = perf_counter()
+    try:
+        async with session_scope() as session:
+            async with transaction(session):
+                await session.execute(insert(SubmissionDB).values(rows))
+    except Exception:
+        logging.exception("Writing %d submissions failed", len(rows))
+        metrics.failed += len(rows)
+        return
+    finally:
+        metrics.write_time += perf_counter() - started
+    metrics.written += len(rows)
+    metrics.batches += 1
@@ -1,5 +1,6 @@
-from sqlalchemy import select
+from sqlalchemy import select, func
 from sqlalchemy.exc import NoResultFound, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.models.team import (
     TeamReg,
@@ -11,19 +12,30 @@ from app.models.team import (
     ChallForTeamPub,
     TeamPubList,
     TeamPubForList,
+    TeamGraph,
 )
-from app.db.models import User as UserDB, Team as TeamDB
-from app.db import session_genr
-from app.utils import hashing
+from app import bus, scoreboard
+from app.chall import uncount_solves
+from app.user import user_points_stmt
+from app.db.models import (
+    User as UserDB,
+    Team as TeamDB,
+    Chall as ChallDB,
+    Solve as SolveDB,
+)
+from app.db import session_scope, transaction, release
+from app.utils import hashing, cursor
+from app.config import SCOREBOARD_CACHE
 
 
 async def create_team(user_id: int, team_details: TeamReg) -> bool:
-    async with session_genr() as session:
+    pass_hash = await hashing.hash_async(team_details.password)
+    async with session_scope() as session:
         try:
-            async with session.begin():
+            async with transaction(session):
                 team = TeamDB(
                     name=team_details.name,
-                    pass_hash=hashing.hash(team_details.password),
+                    pass_hash=pass_hash,
                 )
                 session.add(team)
                 user = await session.get(UserDB, user_id)
@@ -35,72 +47,88 @@ async def create_team(user_id: int, team_details: TeamReg) -> bool:
                     raise ZeroDivisionError
         except IntegrityError:
             return False
+    await bus.publish("team_create", team_id=team.id, name=team.name, user_id=user_id)
     return True
 
 
 async def delete_team(team_id: int) -> bool:
-    async with session_genr() as session:
-        async with session.begin():
+    async with session_scope() as session:
+        async with transaction(session):
             team = await session.get(TeamDB, team_id)
             if not team:
                 return False
 
             # Delete all solves associated with the team
-            for solve in await team.awaitable_attrs.solves:
+            solves = await team.awaitable_attrs.solves
+            for solve in solves:
                 await session.delete(solve)
+            await uncount_solves(session, [solve.chall_id for solve in solves])
 
             # Disassociate all users from the team
+            user_ids = []
             for user in await team.awaitable_attrs.users:
+                user_ids.append(user.id)
                 user.team_id = None
 
             # --- ADD THIS LINE TO DELETE THE TEAM RECORD ITSELF ---
             await session.delete(team)
 
+    await bus.publish("team_delete", team_id=team_id, user_ids=user_ids)
     return True
 
 async def update_team(team_id: int, details: TeamUpdate) -> bool:
-    async with session_genr() as session:
+    if details.password:
+        pass_hash = await hashing.hash_async(details.password)
+    async with session_scope() as session:
         try:
-            async with session.begin():
+            async with transaction(session):
                 team = await session.get(TeamDB, team_id)
                 if not team:
                     raise NoResultFound
                 if details.name:
                     team.name = details.name
                 if details.password:
-                    team.pass_hash = hashing.hash(details.password)
+                    team.pass_hash = pass_hash
         except IntegrityError:
             return False
-    return True
-
-
-async def check_team_passwd(team_id: int, passwd) -> bool:
-    async with session_genr() as session:
-        team = await session.get(TeamDB, team_id)
-        if not team:
-            raise NoResultFound
-        if not hashing.verify(passwd, team.pass_hash):
-            return False
+    await bus.publish("team_update", team_id=team.id, name=team.name)
     return True
 
 
 async def add_user_to_team(
     user_id: int, details: TeamJoinReq, check_pass: bool = True
 ) -> bool:
-    async with session_genr() as session:
+    async with session_scope() as session:
+        row = (
+            await session.execute(
+                select(TeamDB.id, TeamDB.pass_hash).filter_by(name=details.name)
+            )
+        ).one_or_none()
+        if not row:
+            return False
+        team_id, stored_hash = row
+        # The password is checked before the transaction, no pooled
+        # connection is held while hashing
+        await release(session)
+        new_hash = None
+        if check_pass:
+            valid, new_hash = await hashing.verify_and_update_async(
+                details.password, stored_hash
+            )
+            if not valid:
+                return False
         try:
-            async with session.begin():
-                team = (
-                    await session.execute(select(TeamDB).filter_by(name=details.name))
-                ).scalar_one()
+            async with transaction(session):
+                team = await session.get(TeamDB, team_id, populate_existing=True)
+                # Gone or given a new password meanwhile
+                if not team or (check_pass and team.pass_hash != stored_hash):
+                    return False
                 user = await session.get(UserDB, user_id)
                 if not user:
                     raise RuntimeError("User id not corresponding to a user")
-                if check_pass and not await check_team_passwd(
-                    team.id, details.password
-                ):
-                    return False
-                if not user.team:
+                if new_hash:
+                    team.pass_hash = new_hash
+                if not await user.awaitable_attrs.team:
                     user.team = team
                 else:
                     raise ZeroDivisionError
@@ -108,14 +136,15 @@ async def add_user_to_team(
             return False
         except ZeroDivisionError:
             raise NoResultFound
+    await bus.publish("team_join", user_id=user_id, team_id=team.id)
     return True
 
 
 async def unlink_user_from_team(
     user_id: int, caller_user_id: int | None = None
 ) -> bool:
-    async with session_genr() as session:
-        async with session.begin():
+    async with session_scope() as session:
+        async with transaction(session):
             user = await session.get(UserDB, user_id)
             if not user:
                 return False
@@ -129,87 +158,111 @@ async def unlink_user_from_team(
                     return False
                 if caller_user.team_id != user.team_id:
                     return False
-            for solve in await user.awaitable_attrs.solves:
+            solves = await user.awaitable_attrs.solves
+            for solve in solves:
                 await session.delete(solve)
+            await uncount_solves(session, [solve.chall_id for solve in solves])
+            team_id = user.team_id
             user.team_id = None
+    await bus.publish("team_leave", user_id=user_id, team_id=team_id)
     return True
 
 
-async def get_points_of_team(team: TeamDB) -> int:
-    return sum(
-        [
-            (await solve.awaitable_attrs.chall).points
-            for solve in await team.awaitable_attrs.solves
-        ]
-    )
-
-
-async def get_points_of_user(user: UserDB) -> int:
-    return sum(
-        [
-            (await solve.awaitable_attrs.chall).points
-            for solve in await user.awaitable_attrs.solves
-        ]
-    )
-
-
-async def get_solves_of_team(team: TeamDB) -> list[ChallForTeamPub]:
-    return [
-        ChallForTeamPub(
-            id=(await solve.awaitable_attrs.chall).id,
-            name=(await solve.awaitable_attrs.chall).name,
-            points=(await solve.awaitable_attrs.chall).points,
+def team_points_stmt():
+    return (
+        select(
+            TeamDB.id,
+            TeamDB.name,
+            func.coalesce(func.sum(ChallDB.points), 0).label("points"),
         )
-        for solve in await team.awaitable_attrs.solves
-    ]
+        .outerjoin(SolveDB, SolveDB.team_id == TeamDB.id)
+        .outerjoin(ChallDB, ChallDB.id == SolveDB.chall_id)
+        .group_by(TeamDB.id, TeamDB.name)
+    )
 
 
-async def get_users_of_team(team: TeamDB) -> list[UserForTeamPub]:
-    return [
-        UserForTeamPub(
-            id=user.id, username=user.username, points=await get_points_of_user(user)
-        )
-        for user in await team.awaitable_attrs.users
-    ]
+def team_rank_stmt():
+    return team_points_stmt().add_columns(func.max(SolveDB.time).label("last_solve"))
 
 
-async def get_team_for_pub_list(team: TeamDB) -> TeamPubForList:
-    return TeamPubForList(
-        id=team.id,
-        name=team.name,
-        points=await get_points_of_team(team),
+async def get_team_pub_list(limit: int | None, after: str | None = None) -> TeamPubList:
+    """
+    Teams in rank order, `limit` at a time (all if None) from the cursor
+    `after`. Raises ValueError if the cursor is malformed.
+    """
+    key = cursor.decode_rank(after) if after else None
+    if SCOREBOARD_CACHE:
+        return scoreboard.get_team_pub_list(limit, key)
+    async with session_scope() as session:
+        rows = (
+            await session.execute(
+                cursor.rank_page_stmt(
+                    team_rank_stmt(), cursor.fetch_size(limit), key
+                )
+            )
+        ).all()
+    return TeamPubList(
+        teams=[
+            TeamPubForList(id=row.id, name=row.name, points=row.points)
+            for row in rows[:limit]
+        ],
+        next=cursor.encode_rank_row(rows[limit - 1]) if cursor.has_next(rows, limit) else None,
     )
 
 
-async def get_team_pub_list() -> TeamPubList:
-    async with session_genr() as session:
-        return TeamPubList(
-            teams=[
-                await get_team_for_pub_list(team)
-                for team in await session.scalars(select(TeamDB))
-            ]
-        )
+async def get_team_graph(top: int, bucket: int) -> TeamGraph:
+    if SCOREBOARD_CACHE:
+        return scoreboard.get_team_graph(top, bucket)
+    async with session_scope() as session:
+        top_teams = (
+            await session.execute(cursor.rank_page_stmt(team_rank_stmt(), top))
+        ).all()
+        series = {team.id: [] for team in top_teams}
+        for row in await session.execute(
+            select(SolveDB.team_id, SolveDB.time, ChallDB.points)
+            .join(ChallDB, ChallDB.id == SolveDB.chall_id)
+            .where(SolveDB.team_id.in_(series))
+            .order_by(SolveDB.time)
+        ):
+            series[row.team_id].append((row.time.timestamp(), row.points))
+    return scoreboard.build_graph(
+        [(team.id, team.name, series[team.id]) for team in top_teams], bucket
+    )
 
 
-async def get_team_pub_from_obj(team: TeamDB) -> TeamPub:
+async def get_team_pub_from_id(session: AsyncSession, team_id: int) -> TeamPub:
+    team = (
+        await session.execute(team_points_stmt().where(TeamDB.id == team_id))
+    ).one()
+    users = await session.execute(
+        user_points_stmt().where(UserDB.team_id == team_id).order_by(UserDB.id)
+    )
+    solves = await session.execute(
+        select(ChallDB.id, ChallDB.name, ChallDB.points)
+        .join(SolveDB, SolveDB.chall_id == ChallDB.id)
+        .where(SolveDB.team_id == team_id)
+        .order_by(SolveDB.id)
+    )
     return TeamPub(
-        **(await get_team_for_pub_list(team)).model_dump(),
-        users=await get_users_of_team(team),
-        solves=await get_solves_of_team(team),
+        id=team.id,
+        name=team.name,
+        points=team.points,
+        users=[
+            UserForTeamPub(id=row.id, username=row.username, points=row.points)
+            for row in users
+        ],
+        solves=[
+            ChallForTeamPub(id=row.id, name=row.name, points=row.points)
+            for row in solves
+        ],
     )
 
 
 async def get_team_pub(team_id: int) -> TeamPub:
-    async with session_genr() as session:
-        team = await session.get(TeamDB, team_id)
-        if not team:
-            raise NoResultFound
-        return await get_team_pub_from_obj(team)
+    async with session_scope() as session:
+        return await get_team_pub_from_id(session, team_id)
 
 
 async def get_team(team_id: int) -> Team:
-    async with session_genr() as session:
-        team = await session.get(TeamDB, team_id)
-        if not team:
-            raise NoResultFound
-        return Team(**(await get_team_pub_from_obj(team)).model_dump())
+    async with session_scope() as session:
+        return Team(**(await get_team_pub_from_id(session, team_id)).model_dump())
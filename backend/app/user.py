@@ -2,6 +2,7 @@ import time
 
 from sqlalchemy import select ,func
 from sqlalchemy.exc import NoResultFound, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.db.models import Solve as SolveDB
 
 from app.models.user import (
@@ -13,32 +14,40 @@ from app.models.user import (
     UserPubList,
     UserPubForList,
 )
-from app.db.models import User as UserDB
-from app.db import session_genr
-from app.utils import hashing, JWTmgmt
-from app.config import ADMIN_USER, ADMIN_PASSWORD
+from app import bus, scoreboard
+from app.chall import uncount_solves
+from app.db.models import User as UserDB, Team as TeamDB, Chall as ChallDB
+from app.db import session_scope, transaction
+from app.utils import hashing, JWTmgmt, cursor
+from app.config import ADMIN_USER, ADMIN_PASSWORD, SCOREBOARD_CACHE
 
 
 async def create_user(user: UserReg, admin: bool = False) -> bool:
-    async with session_genr() as session:
+    pass_hash = await hashing.hash_async(user.password)
+    async with session_scope() as session:
         try:
-            async with session.begin():
-                session.add(
-                    UserDB(
-                        username=user.username,
-                        email=user.email,
-                        pass_hash=hashing.hash(user.password),
-                        admin=admin,
-                        email_verified=False,
-                    )
+            async with transaction(session):
+                user_obj = UserDB(
+                    username=user.username,
+                    email=user.email,
+                    pass_hash=pass_hash,
+                    admin=admin,
+                    email_verified=False,
                 )
+                session.add(user_obj)
         except IntegrityError:
             return False
+    await bus.publish(
+        "user_create",
+        user_id=user_obj.id,
+        name=user_obj.username,
+        admin=user_obj.admin,
+    )
     return True
 
 async def delete_user(user_id: int) -> bool:
-    async with session_genr() as session:
-        async with session.begin():
+    async with session_scope() as session:
+        async with transaction(session):
             user = await session.get(UserDB, user_id)
             if not user:
                 return False
@@ -52,29 +61,33 @@ async def delete_user(user_id: int) -> bool:
                     return False
             
             # Delete all solves of the user
-            solves = await session.scalars(
-                select(SolveDB).where(SolveDB.user_id == user_id)
-            )
+            solves = (
+                await session.scalars(select(SolveDB).where(SolveDB.user_id == user_id))
+            ).all()
             for solve in solves:
                 await session.delete(solve)
+            await uncount_solves(session, [solve.chall_id for solve in solves])
             
             # Finally, delete the user
             await session.delete(user)
+    await bus.publish("user_delete", user_id=user_id)
     return True
 
 
 
 async def update_user(user_id: int, details: UserUpdateInternal) -> bool:
-    async with session_genr() as session:
+    if details.password:
+        pass_hash = await hashing.hash_async(details.password)
+    async with session_scope() as session:
         try:
-            async with session.begin():
+            async with transaction(session):
                 user = await session.get(UserDB, user_id)
                 if not user:
                     raise NoResultFound
                 if details.username:
                     user.username = details.username
                 if details.password:
-                    user.pass_hash = hashing.hash(details.password)
+                    user.pass_hash = pass_hash
                 if details.email:
                     if user.email != details.email:
                         user.email = details.email
@@ -85,6 +98,9 @@ async def update_user(user_id: int, details: UserUpdateInternal) -> bool:
                     user.email_verified = details.email_verified
         except IntegrityError:
             return False
+    await bus.publish(
+        "user_update", user_id=user.id, name=user.username, admin=user.admin
+    )
     return True
 
 
@@ -99,14 +115,17 @@ async def verify_user_email_token(token: str) -> bool:
         email = d["email"]
     except KeyError:
         return False
-    async with session_genr() as session:
-        async with session.begin():
+    async with session_scope() as session:
+        async with transaction(session):
             user = await session.get(UserDB, user_id)
             if not user:
                 return False
             if email != user.email:
                 return False
             user.email_verified = True
+    await bus.publish(
+        "user_update", user_id=user.id, name=user.username, admin=user.admin
+    )
     return True
 
 
@@ -117,75 +136,93 @@ async def create_admin():
     )
 
 
-async def get_points_of_user(user: UserDB) -> int:
-    return sum(
-        [
-            (await solve.awaitable_attrs.chall).points
-            for solve in await user.awaitable_attrs.solves
-        ]
+def user_points_stmt():
+    return (
+        select(
+            UserDB.id,
+            UserDB.username,
+            UserDB.team_id,
+            TeamDB.name.label("team_name"),
+            func.coalesce(func.sum(ChallDB.points), 0).label("points"),
+        )
+        .outerjoin(TeamDB, TeamDB.id == UserDB.team_id)
+        .outerjoin(SolveDB, SolveDB.user_id == UserDB.id)
+        .outerjoin(ChallDB, ChallDB.id == SolveDB.chall_id)
+        .group_by(UserDB.id, UserDB.username, UserDB.team_id, TeamDB.name)
     )
 
 
-async def get_solves_of_user(user: UserDB) -> list[ChallForUserPub]:
-    return [
-        ChallForUserPub(
-            id=(await solve.awaitable_attrs.chall).id,
-            name=(await solve.awaitable_attrs.chall).name,
-            points=(await solve.awaitable_attrs.chall).points,
-        )
-        for solve in await user.awaitable_attrs.solves
-    ]
+def get_user_for_pub_list(row) -> UserPubForList:
+    return UserPubForList(
+        id=row.id,
+        name=row.username,
+        team_id=row.team_id,
+        team_name=row.team_name,
+        points=row.points,
+    )
 
 
-async def get_user_for_pub_list(user: UserDB) -> UserPubForList:
-    if not await user.awaitable_attrs.team:
-        team_id = team_name = None
-    else:
-        team_id = (await user.awaitable_attrs.team).id
-        team_name = (await user.awaitable_attrs.team).name
-    return UserPubForList(
-        id=user.id,
-        name=user.username,
-        team_id=team_id,
-        team_name=team_name,
-        points=await get_points_of_user(user),
+def user_rank_stmt():
+    return (
+        user_points_stmt()
+        .add_columns(func.max(SolveDB.time).label("last_solve"))
+        .where(UserDB.admin == False)
     )
 
 
-async def get_user_pub_list() -> UserPubList:
-    async with session_genr() as session:
-        return UserPubList(
-            users=[
-                await get_user_for_pub_list(user)
-                for user in await session.scalars(
-                    select(UserDB).where(UserDB.admin == False)
+async def get_user_pub_list(limit: int | None, after: str | None = None) -> UserPubList:
+    """
+    Users in rank order, `limit` at a time (all if None) from the cursor
+    `after`. Raises ValueError if the cursor is malformed.
+    """
+    key = cursor.decode_rank(after) if after else None
+    if SCOREBOARD_CACHE:
+        return scoreboard.get_user_pub_list(limit, key)
+    async with session_scope() as session:
+        rows = (
+            await session.execute(
+                cursor.rank_page_stmt(
+                    user_rank_stmt(), cursor.fetch_size(limit), key
                 )
-            ]
-        )
+            )
+        ).all()
+    return UserPubList(
+        users=[get_user_for_pub_list(row) for row in rows[:limit]],
+        next=cursor.encode_rank_row(rows[limit - 1]) if cursor.has_next(rows, limit) else None,
+    )
 
 
-async def get_user_pub_from_obj(user: UserDB) -> UserPub:
+async def get_user_pub_from_id(session: AsyncSession, user_id: int) -> UserPub:
+    user = (
+        await session.execute(user_points_stmt().where(UserDB.id == user_id))
+    ).one()
+    solves = await session.execute(
+        select(ChallDB.id, ChallDB.name, ChallDB.points)
+        .join(SolveDB, SolveDB.chall_id == ChallDB.id)
+        .where(SolveDB.user_id == user_id)
+        .order_by(SolveDB.id)
+    )
     return UserPub(
-        **(await get_user_for_pub_list(user)).model_dump(),
-        solves=await get_solves_of_user(user),
+        **get_user_for_pub_list(user).model_dump(),
+        solves=[
+            ChallForUserPub(id=row.id, name=row.name, points=row.points)
+            for row in solves
+        ],
     )
 
 
 async def get_user_pub(user_id: int) -> UserPub:
-    async with session_genr() as session:
-        user = await session.get(UserDB, user_id)
-        if not user:
-            raise NoResultFound
-        return await get_user_pub_from_obj(user)
+    async with session_scope() as session:
+        return await get_user_pub_from_id(session, user_id)
 
 
 async def get_user(user_id: int) -> UserPub:
-    async with session_genr() as session:
+    async with session_scope() as session:
         user = await session.get(UserDB, user_id)
         if not user:
             raise RuntimeError("Logged user's id not corresponding to a user")
         return User(
-            **(await get_user_pub_from_obj(user)).model_dump(),
+            **(await get_user_pub_from_id(session, user_id)).model_dump(),
             admin=user.admin,
             email=user.email,
             email_verified=user.email_verified,
@@ -3,7 +3,7 @@ from enum import StrEnum
 from typing import Literal
 
 import jwt
-from jwt.exceptions import DecodeError, InvalidSignatureError
+from jwt.exceptions import InvalidTokenError
 
 from app.config import JWT_ALG, JWT_HS256_SECRET
 
@@ -37,5 +37,5 @@ def verify_token(
         raise NotImplementedError("Only HS256 algorithm is implemeted yet")
     try:
         return jwt.decode(token, key=secret, algorithms=[alg.value])
-    except (DecodeError, InvalidSignatureError):
+    except InvalidTokenError:
         return False
@@ -0,0 +1,101 @@
+import base64
+import json
+import math
+from datetime import datetime
+from types import NoneType
+
+from sqlalchemy import Select, desc, or_, and_, select
+
+# Opaque keyset pagination cursors. A cursor is the sort key of the last item
+# of a page, and the next page starts right after it.
+
+
+def encode(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+# Timestamps past this don't convert to a datetime
+MAX_TIMESTAMP = datetime(9999, 12, 31).timestamp()
+
+
+def valid(value, types: type | tuple) -> bool:
+    types = types if isinstance(types, tuple) else (types,)
+    if not isinstance(value, types) or isinstance(value, bool):
+        return False
+    # Values that may be floats are timestamps. JSON also allows Infinity and
+    # NaN, which fail this too.
+    if float in types and value is not None:
+        return 0 <= value <= MAX_TIMESTAMP
+    return True
+
+
+def decode(cursor: str, types: tuple) -> tuple:
+    """
+    Raises ValueError if the cursor is malformed.
+    """
+    key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    if (
+        not isinstance(key, list)
+        or len(key) != len(types)
+        or not all(valid(v, t) for v, t in zip(key, types))
+    ):
+        raise ValueError("Malformed cursor")
+    return tuple(key)
+
+
+# Rank key of a team or user: (-points, last solve timestamp, id), where no
+# solves is an infinite timestamp so it ranks after any solve
+def encode_rank(key: tuple) -> str:
+    neg_points, last_solve, id = key
+    return encode((neg_points, None if last_solve == math.inf else last_solve, id))
+
+
+def decode_rank(cursor: str) -> tuple:
+    neg_points, last_solve, id = decode(cursor, (int, (float, int, NoneType), int))
+    return neg_points, math.inf if last_solve is None else last_solve, id
+
+
+def encode_rank_row(row) -> str:
+    last_solve = row.last_solve.timestamp() if row.last_solve else math.inf
+    return encode_rank((-row.points, last_solve, row.id))
+
+
+def fetch_size(limit: int | None) -> int | None:
+    # One extra row tells if there is a next page
+    return None if limit is None else limit + 1
+
+
+def has_next(rows: list, limit: int | None) -> bool:
+    return limit is not None and len(rows) > limit
+
+
+def rank_page_stmt(
+    stmt: Select, limit: int | None, after: tuple | None = None
+) -> Select:
+    """
+    Up to `limit` rows (all if None) of `stmt`, which must have points, last_solve and id
+    columns, in rank order after the rank key `after`.
+    """
+    sub = stmt.subquery()
+    page = (
+        select(sub)
+        .order_by(
+            desc(sub.c.points), sub.c.last_solve.is_(None), sub.c.last_solve, sub.c.id
+        )
+        .limit(limit)
+    )
+    if after is None:
+        return page
+    neg_points, last_solve, id = after
+    if last_solve == math.inf:
+        tie = and_(sub.c.last_solve.is_(None), sub.c.id > id)
+    else:
+        last_solve = datetime.fromtimestamp(last_solve)
+        tie = or_(
+            sub.c.last_solve > last_solve,
+            sub.c.last_solve.is_(None),
+            and_(sub.c.last_solve == last_solve, sub.c.id > id),
+        )
+    return page.where(
+        or_(sub.c.points < -neg_points, and_(sub.c.points == -neg_points, tie))
+    )
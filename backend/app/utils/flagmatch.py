@@ -0,0 +1,248 @@
+import hashlib
+import hmac
+import logging
+import re
+from enum import StrEnum
+from re import _parser  # no public API for the parsed pattern
+
+from app.config import FLAG_REGEX_MAX_LEN, FLAG_HMAC_SECRET, FLAG_HMAC_LEN
+
+
+class FlagKind(StrEnum):
+    exact = "exact"
+    icase = "icase"  # case-insensitive
+    regex = "regex"  # must match the whole submission
+    team = "team"  # per team, the flag is the prefix: prefix{token}
+
+
+def digest(flag: str) -> bytes:
+    return hashlib.sha256(flag.encode()).digest()
+
+
+def team_token(chall_id: int, team_id: int) -> str:
+    """
+    Raises ValueError if personalized flags aren't configured.
+    """
+    if not FLAG_HMAC_SECRET:
+        raise ValueError("FLAG_HMAC_SECRET isn't set")
+    return hmac.new(
+        FLAG_HMAC_SECRET.encode(), f"{chall_id}:{team_id}".encode(), hashlib.sha256
+    ).hexdigest()[:FLAG_HMAC_LEN]
+
+
+def team_flag(prefix: str, chall_id: int, team_id: int) -> str:
+    return f"{prefix}{{{team_token(chall_id, team_id)}}}"
+
+
+def split_team_flag(prefix: str, flag: str) -> str | None:
+    """
+    The token of a flag in the personalized format of `prefix`.
+    """
+    if flag.startswith(prefix + "{") and flag.endswith("}"):
+        return flag[len(prefix) + 1 : -1]
+    return None
+
+
+REPEATS = (_parser.MAX_REPEAT, _parser.MIN_REPEAT)
+# Characters are code points up to 255, with OTHER standing for all the rest
+OTHER = 256
+ALL = frozenset(range(OTHER + 1))
+CATEGORIES = {
+    category: frozenset(c for c in range(OTHER) if re.match(regex, chr(c))) | {OTHER}
+    for category, regex in (
+        (_parser.CATEGORY_DIGIT, r"\d"),
+        (_parser.CATEGORY_NOT_DIGIT, r"\D"),
+        (_parser.CATEGORY_SPACE, r"\s"),
+        (_parser.CATEGORY_NOT_SPACE, r"\S"),
+        (_parser.CATEGORY_WORD, r"\w"),
+        (_parser.CATEGORY_NOT_WORD, r"\W"),
+    )
+}
+
+
+def backtracks(tree, in_repeat: bool = False) -> bool:
+    for op, av in tree:
+        repeat = op in REPEATS and av[1] > 1
+        # Alternatives of single characters are already turned into a set
+        if in_repeat and (op in REPEATS and av[0] != av[1] or op is _parser.BRANCH):
+            return True
+        for child in av if isinstance(av, (tuple, list)) else (av,):
+            for sub in child if isinstance(child, list) else (child,):
+                if isinstance(sub, _parser.SubPattern) and backtracks(
+                    sub, in_repeat or repeat
+                ):
+                    return True
+    return False
+
+
+def charset(tree, icase: bool) -> frozenset[int]:
+    """
+    The characters `tree` can match if it is a single character, otherwise
+    any of them.
+    """
+    if len(tree) != 1:
+        return ALL
+    op, av = tree[0]
+    if op is _parser.LITERAL:
+        chars = {min(av, OTHER)}
+    elif op is _parser.NOT_LITERAL:
+        chars = ALL - {av} | {OTHER}
+    elif op is _parser.IN:
+        chars = set()
+        for item, arg in av:
+            if item is _parser.LITERAL:
+                chars.add(min(arg, OTHER))
+            elif item is _parser.RANGE:
+                chars.update(range(arg[0], min(arg[1], OTHER - 1) + 1))
+                if arg[1] >= OTHER:
+                    chars.add(OTHER)
+            elif item is _parser.CATEGORY:
+                chars |= CATEGORIES[arg]
+            elif item is not _parser.NEGATE:
+                return ALL
+        if av and av[0][0] is _parser.NEGATE:
+            chars = ALL - chars | {OTHER}
+    else:
+        return ALL
+    if icase:
+        chars |= {
+            min(ord(c.swapcase()[0]), OTHER) for c in map(chr, chars - {OTHER})
+        } | {OTHER}
+    return frozenset(chars)
+
+
+def overlaps(tree, icase: bool = False) -> bool:
+    """
+    True if variable width repeats in a row can match the same characters,
+    like \\w*\\w* or .*_.*, so that a submission can be split between them in
+    polynomially many ways.
+    """
+    # Characters of the variable width repeats that nothing has closed yet
+    open_repeats: list[frozenset[int]] = []
+    for op, av in tree:
+        if op is _parser.SUBPATTERN:
+            _, add_flags, del_flags, sub = av
+            sub_icase = (icase or add_flags & re.IGNORECASE) and not (
+                del_flags & re.IGNORECASE
+            )
+            if overlaps(sub, sub_icase):
+                return True
+            chars = ALL
+        elif op in REPEATS:
+            if overlaps(av[2], icase):
+                return True
+            chars = charset(av[2], icase)
+            if av[0] != av[1]:
+                if any(chars & other for other in open_repeats):
+                    return True
+                open_repeats.append(chars)
+                continue
+        elif op in (_parser.AT, _parser.ASSERT, _parser.ASSERT_NOT):
+            # Zero width
+            continue
+        else:
+            for child in av if isinstance(av, (tuple, list)) else (av,):
+                for sub in child if isinstance(child, list) else (child,):
+                    if isinstance(sub, _parser.SubPattern) and overlaps(sub, icase):
+                        return True
+            chars = charset([(op, av)], icase)
+        # A character none of them can match ends them
+        open_repeats = [other for other in open_repeats if chars & other]
+    return False
+
+
+def compile_regex(pattern: str) -> re.Pattern:
+    """
+    Raises ValueError if the pattern is invalid, or can backtrack badly
+    whatever the submission: a variable width repeat or an alternation inside
+    a repeat, like (a+)+, (a?){25} or (a|ab)*, or variable width repeats in a
+    row that can match the same characters, like \\w*\\w*. Conservative, some
+    safe patterns are refused too.
+    """
+    try:
+        tree = _parser.parse(pattern)
+        if backtracks(tree):
+            raise ValueError(
+                "Repeats and alternations inside repeats aren't allowed in flag regexes"
+            )
+        if overlaps(tree, bool(tree.state.flags & re.IGNORECASE)):
+            raise ValueError(
+                "Repeats in a row that can match the same characters aren't allowed"
+                " in flag regexes"
+            )
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid flag regex: {e}")
+
+
+def check_flag(kind: FlagKind, flag: str) -> None:
+    """
+    Raises ValueError if `flag` can't be used as a flag of this kind.
+    """
+    if kind == FlagKind.regex:
+        compile_regex(flag)
+    elif kind == FlagKind.team and not FLAG_HMAC_SECRET:
+        raise ValueError("FLAG_HMAC_SECRET isn't set")
+
+
+class Matcher:
+    """
+    The accepted flags of a challenge, prepared once so that checking a
+    submission is a set lookup, a precompiled match or an HMAC.
+    """
+
+    __slots__ = ("chall_id", "exact", "icase", "regexes", "team_prefixes")
+
+    def __init__(self, chall_id: int, flags: list[tuple[str, str]]):
+        self.chall_id = chall_id
+        # Lookups are by digest, so their timing tells nothing about the flags
+        self.exact: set[bytes] = set()
+        self.icase: set[bytes] = set()
+        self.regexes: list[re.Pattern] = []
+        self.team_prefixes: list[str] = []
+        for kind, flag in flags:
+            match FlagKind(kind):
+                case FlagKind.exact:
+                    self.exact.add(digest(flag))
+                case FlagKind.icase:
+                    self.icase.add(digest(flag.casefold()))
+                case FlagKind.regex:
+                    try:
+                        self.regexes.append(compile_regex(flag))
+                    except ValueError as e:
+                        # Added before the checks got stricter, never run it
+                        logging.error(
+                            "Skipping a flag regex of challenge %d: %s", chall_id, e
+                        )
+                case FlagKind.team:
+                    self.team_prefixes.append(flag)
+
+    def __call__(self, flag: str, team_id: int) -> bool:
+        if digest(flag) in self.exact:
+            return True
+        if self.icase and digest(flag.casefold()) in self.icase:
+            return True
+        if self.team_prefixes and FLAG_HMAC_SECRET:
+            token = team_token(self.chall_id, team_id)
+            for prefix in self.team_prefixes:
+                submitted = split_team_flag(prefix, flag)
+                if submitted is not None and hmac.compare_digest(
+                    submitted.encode(), token.encode()
+                ):
+                    return True
+        # Caps the cost of a pattern that backtracks badly
+        if len(flag) > FLAG_REGEX_MAX_LEN:
+            return False
+        return any(regex.fullmatch(flag) for regex in self.regexes)
+
+    def tokens(self, flag: str) -> list[str]:
+        """
+        The tokens `flag` carries if it looks like a personalized flag.
+        """
+        if not FLAG_HMAC_SECRET:
+            return []
+        return [
+            token
+            for prefix in self.team_prefixes
+            if (token := split_team_flag(prefix, flag)) is not None
+        ]
@@ -1,8 +1,21 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import StrEnum
+from time import perf_counter
 
 from passlib.context import CryptContext
 
-from app.config import PASSWD_HASH_SCHEME
+from app.config import (
+    PASSWD_HASH_SCHEME,
+    ARGON2_TIME_COST,
+    ARGON2_MEMORY_COST,
+    ARGON2_PARALLELISM,
+    BCRYPT_ROUNDS,
+    HASH_WORKERS,
+    HASH_QUEUE_MAX,
+)
 
 
 class HashScheme(StrEnum):
@@ -10,7 +23,18 @@ class HashScheme(StrEnum):
     bcrypt = "bcrypt"
 
 
-ctx = CryptContext(schemes=[HashScheme[PASSWD_HASH_SCHEME].value], truncate_error=True)
+# Hashes made with another scheme or other costs still verify, but are flagged
+# by needs_update, so changing these rehashes users as they log in
+ctx = CryptContext(
+    schemes=[scheme.value for scheme in HashScheme],
+    default=HashScheme[PASSWD_HASH_SCHEME].value,
+    deprecated="auto",
+    argon2__rounds=ARGON2_TIME_COST,
+    argon2__memory_cost=ARGON2_MEMORY_COST,
+    argon2__parallelism=ARGON2_PARALLELISM,
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    truncate_error=True,
+)
 
 
 def hash(passwd: str | bytes) -> str:
@@ -19,3 +43,146 @@ def hash(passwd: str | bytes) -> str:
 
 def verify(passwd: str | bytes, hash: str) -> bool:
     return ctx.verify(passwd, hash)
+
+
+def verify_and_update(passwd: str | bytes, hash: str) -> tuple[bool, str | None]:
+    """
+    Also returns a new hash if the password is right but the stored hash is
+    outdated, None otherwise.
+    """
+    return ctx.verify_and_update(passwd, hash)
+
+
+# argon2 and bcrypt release the GIL, so a thread pool hashes in parallel
+# without blocking the event loop. Callers queue on the semaphore rather than
+# in the executor, so the queue depth is visible and a cancelled request
+# leaves nothing behind to hash.
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hashing")
+slots = asyncio.Semaphore(HASH_WORKERS)
+
+
+class Overloaded(Exception):
+    """
+    Too many hashes are queued already, the request should be retried later.
+    """
+
+
+@dataclass(slots=True)
+class Metrics:
+    calls: int = 0
+    rejected: int = 0
+    running: int = 0
+    waiting: int = 0
+    max_waiting: int = 0
+    wait_time: float = 0  # total, in seconds
+    run_time: float = 0  # total, in seconds
+
+
+metrics = Metrics()
+
+
+async def run(func, *args):
+    # Shed load instead of queueing without bound, so a login storm can't
+    # hold up requests that don't hash anything
+    if metrics.waiting >= HASH_QUEUE_MAX:
+        metrics.rejected += 1
+        raise Overloaded
+    queued = perf_counter()
+    metrics.waiting += 1
+    metrics.max_waiting = max(metrics.max_waiting, metrics.waiting)
+    try:
+        await slots.acquire()
+    finally:
+        metrics.waiting -= 1
+    started = perf_counter()
+    metrics.wait_time += started - queued
+    metrics.running += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    finally:
+        slots.release()
+        metrics.running -= 1
+        metrics.calls += 1
+        metrics.run_time += perf_counter() - started
+
+
+async def hash_async(passwd: str | bytes) -> str:
+    return await run(hash, passwd)
+
+
+async def verify_async(passwd: str | bytes, hash: str) -> bool:
+    return await run(verify, passwd, hash)
+
+
+async def verify_and_update_async(
+    passwd: str | bytes, hash: str
+) -> tuple[bool, str | None]:
+    return await run(verify_and_update, passwd, hash)
+
+
+def bench(time_cost: int, memory_cost: int, parallelism: int, runs: int = 3) -> float:
+    handler = ctx.handler("argon2").using(
+        rounds=time_cost, memory_cost=memory_cost, parallelism=parallelism
+    )
+    best = float("inf")
+    for _ in range(runs):
+        start = perf_counter()
+        handler.hash("calibration")
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def calibrate() -> None:
+    """
+    Finds the argon2 costs that take about the target time on this host.
+    Memory is raised first since it's what makes cracking expensive, the time
+    cost then fills up what is left of the target.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m app.utils.hashing",
+        description="Calibrate argon2 costs for this host",
+    )
+    parser.add_argument("--target-ms", type=float, default=250, help="per hash")
+    parser.add_argument("--max-memory", type=int, default=256, help="in MiB")
+    parser.add_argument("--parallelism", type=int, default=ARGON2_PARALLELISM)
+    parser.add_argument("--max-time-cost", type=int, default=10)
+    args = parser.parse_args()
+    target = args.target_ms / 1000
+
+    best = None
+    memory_mib = 16
+    while memory_mib <= args.max_memory:
+        memory_cost = memory_mib * 1024
+        time_cost = 0
+        took = 0.0
+        # Stop before the time cost that overshoots the target
+        while time_cost < args.max_time_cost:
+            t = bench(time_cost + 1, memory_cost, args.parallelism)
+            if t > target:
+                break
+            time_cost, took = time_cost + 1, t
+        if not time_cost:
+            print(f"m={memory_mib:>4} MiB: over target even with t=1")
+            break
+        print(f"m={memory_mib:>4} MiB: t={time_cost:<2} {took * 1000:7.1f} ms")
+        # t=1 is weaker against tradeoff attacks, take it only if nothing else fits
+        if not best or time_cost > 1 or best[0] == 1:
+            best = (time_cost, memory_cost)
+        memory_mib *= 2
+
+    if not best:
+        print("No argon2 parameters fit the target, raise --target-ms")
+        return
+    time_cost, memory_cost = best
+    print()
+    print(f"ARGON2_TIME_COST = {time_cost}")
+    print(f"ARGON2_MEMORY_COST = {memory_cost}")
+    print(f"ARGON2_PARALLELISM = {args.parallelism}")
+    print(
+        f"# Up to {memory_cost * HASH_WORKERS // 1024} MiB in use "
+        f"with HASH_WORKERS = {HASH_WORKERS}"
+    )
+
+
+if __name__ == "__main__":
+    calibrate()
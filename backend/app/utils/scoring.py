@@ -0,0 +1,32 @@
+import math
+from enum import StrEnum
+
+
+class Decay(StrEnum):
+    static = "static"
+    linear = "linear"
+    log = "log"
+    ctfd = "ctfd"
+
+
+def chall_value(
+    decay_func: Decay, initial: int, minimum: int, decay: int, solved_cnt: int
+) -> int:
+    """
+    Value of a challenge after `solved_cnt` solves.
+
+    `decay` is the number of solves after which the value bottoms out at
+    `minimum`. The first solve is still worth `initial`, as in CTFd.
+    """
+    if decay_func == Decay.static or decay <= 0:
+        return initial
+    minimum = min(minimum, initial)
+    n = min(max(solved_cnt - 1, 0), decay)
+    match decay_func:
+        case Decay.linear:
+            frac = n / decay
+        case Decay.log:
+            frac = math.log1p(n) / math.log1p(decay)
+        case Decay.ctfd:
+            frac = (n / decay) ** 2
+    return max(minimum, math.ceil(initial - (initial - minimum) * frac))
@@ -0,0 +1,101 @@
+from typing import AsyncIterator
+
+from fastapi import Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+
+class MultipartFile:
+    """
+    A file field of a multipart/form-data request, read straight from the
+    request stream instead of being spooled to disk first. Raises ValueError
+    if the request isn't multipart, has no such file or is cut short.
+    """
+
+    def __init__(self, request: Request, field: str):
+        content_type, params = parse_options_header(
+            request.headers.get("content-type", "")
+        )
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise ValueError("Not a multipart/form-data request")
+        self.field = field.encode()
+        self.filename: str | None = None
+        self.stream = request.stream()
+        self.parser = MultipartParser(
+            params[b"boundary"],
+            {
+                "on_part_begin": self.on_part_begin,
+                "on_header_field": self.on_header_field,
+                "on_header_value": self.on_header_value,
+                "on_header_end": self.on_header_end,
+                "on_headers_finished": self.on_headers_finished,
+                "on_part_data": self.on_part_data,
+                "on_part_end": self.on_part_end,
+            },
+        )
+        self.header_field = b""
+        self.header_value = b""
+        self.disposition = b""
+        self.in_file = False
+        self.done = False
+        # Data of the file parsed from the last request chunk
+        self.parsed: list[bytes] = []
+
+    def on_part_begin(self) -> None:
+        self.disposition = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self.header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        if self.header_field.lower() == b"content-disposition":
+            self.disposition = self.header_value
+        self.header_field = self.header_value = b""
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self.disposition)
+        if (
+            self.filename is None
+            and options.get(b"name") == self.field
+            and b"filename" in options
+        ):
+            self.filename = options[b"filename"].decode(errors="replace")
+            self.in_file = True
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self.in_file:
+            self.parsed.append(data[start:end])
+
+    def on_part_end(self) -> None:
+        if self.in_file:
+            self.in_file = False
+            self.done = True
+
+    async def feed(self) -> None:
+        chunk = await anext(self.stream, None)
+        if chunk is None:
+            raise ValueError("Upload cut short")
+        self.parser.write(chunk)
+
+    async def open(self) -> str:
+        """
+        Reads up to the start of the file and returns its name.
+        """
+        while self.filename is None:
+            try:
+                await self.feed()
+            except ValueError:
+                raise ValueError("No file in the request")
+        return self.filename
+
+    async def read(self) -> AsyncIterator[bytes]:
+        while True:
+            if self.parsed:
+                data = b"".join(self.parsed)
+                self.parsed.clear()
+                yield data
+            if self.done:
+                return
+            await self.feed()
@@ -0,0 +1,35 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# Without a local app/config.py the tests run against the example one
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not os.path.exists(os.path.join(BACKEND, "app", "config.py")):
+    loader = importlib.machinery.SourceFileLoader(
+        "app.config", os.path.join(BACKEND, "app", "config.py.example")
+    )
+    spec = importlib.util.spec_from_loader("app.config", loader)
+    config = importlib.util.module_from_spec(spec)
+    loader.exec_module(config)
+    sys.modules["app.config"] = config
+
+from app import db  # noqa: E402
+
+
+@pytest.fixture
+async def database(monkeypatch):
+    """
+    An in-memory SQLite database in place of MySQL, with the tables created.
+    """
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(
+        db, "session_genr", async_sessionmaker(bind=engine, expire_on_commit=False)
+    )
+    await db.init()
+    yield engine
+    await engine.dispose()
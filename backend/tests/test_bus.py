@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import fakeredis
+import pytest
+
+from app import bus
+
+
+class SlowPubSub:
+    """
+    Delivers messages with some latency, as a real connection would.
+    """
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def __getattr__(self, name):
+        return getattr(self.pubsub, name)
+
+    async def listen(self):
+        async for raw in self.pubsub.listen():
+            await asyncio.sleep(0.02)
+            yield raw
+
+
+@pytest.fixture
+async def redis_server():
+    server = fakeredis.FakeServer()
+    conn = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    make_pubsub = conn.pubsub
+    conn.pubsub = lambda: SlowPubSub(make_pubsub())
+    bus.handlers.clear()
+    bus.resync_handlers.clear()
+    bus.last_seq = 0
+    bus.diverged = False
+    await bus.init(conn)
+    yield server
+    await bus.close()
+    bus.publish_script = None
+    bus.resyncer = None
+    await conn.close()
+
+
+def record(kind: str) -> list[bus.Message]:
+    seen = []
+    bus.subscribe(kind, seen.append)
+    return seen
+
+
+async def publish_elsewhere(server, *messages: tuple[str, dict]) -> int:
+    # Another worker, with its own connection to the same Redis
+    conn = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    try:
+        return await conn.register_script(bus.PUBLISH_LUA)(
+            keys=[bus.SEQ_KEY, bus.CHANNEL],
+            args=[json.dumps({"kind": k, "data": d}) for k, d in messages],
+        )
+    finally:
+        await conn.close()
+
+
+def record_resyncs() -> list[int]:
+    # The bus position at each reload
+    seen = []
+
+    async def reload():
+        seen.append(bus.last_seq)
+
+    bus.on_resync(reload)
+    return seen
+
+
+async def wait_for_seq(seq: int) -> None:
+    async with asyncio.timeout(2):
+        while bus.last_seq < seq:
+            await asyncio.sleep(0.01)
+
+
+async def test_publish_applies_before_returning(redis_server):
+    seen = record("solve")
+    await bus.publish("solve", chall_id=1)
+    assert [(m.seq, m.data) for m in seen] == [(1, {"chall_id": 1})]
+
+
+async def test_fan_out_from_other_worker(redis_server):
+    seen = record("solve")
+    other = record("score")
+    await publish_elsewhere(redis_server, ("solve", {"chall_id": 1}), ("score", {}))
+    await wait_for_seq(2)
+    assert [m.seq for m in seen] == [1]
+    assert [m.seq for m in other] == [2]
+
+
+async def test_sequence_order_with_remote_messages_pending(redis_server):
+    seen = record("solve")
+    # Published by another worker, not read by the listener yet when this
+    # worker publishes its own
+    await publish_elsewhere(redis_server, *[("solve", {"n": i}) for i in range(5)])
+    await bus.publish("solve", n=5)
+    await publish_elsewhere(redis_server, ("solve", {"n": 6}))
+    await wait_for_seq(7)
+    assert [m.seq for m in seen] == list(range(1, 8))
+    assert [m.data["n"] for m in seen] == list(range(7))
+
+
+async def test_publish_many_is_consecutive(redis_server):
+    seen = record("solve")
+    await bus.publish_many([("solve", {"n": 0}), ("solve", {"n": 1})])
+    assert [m.seq for m in seen] == [1, 2]
+
+
+async def test_redis_down_applies_without_seq(redis_server):
+    seen = record("solve")
+    await bus.publish("solve", n=0)
+    redis_server.connected = False
+    await bus.publish("solve", n=1)
+    assert [m.seq for m in seen] == [1, None]
+    assert bus.last_seq == 1
+
+
+async def test_gap_resyncs(redis_server):
+    resyncs = record_resyncs()
+    await publish_elsewhere(redis_server, ("solve", {}))
+    await wait_for_seq(1)
+    # A message lost on the way
+    conn = fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True)
+    await conn.incr(bus.SEQ_KEY)
+    await conn.close()
+    await publish_elsewhere(redis_server, ("solve", {}))
+    await wait_for_seq(3)
+    await bus.resyncer
+    assert resyncs == [3]
+
+
+async def test_echo_timeout_resyncs_before_returning(redis_server, monkeypatch):
+    resyncs = record_resyncs()
+    monkeypatch.setattr(bus, "BUS_ECHO_TIMEOUT", 0.05)
+    bus.listener.cancel()
+    await bus.publish("solve")
+    assert resyncs == [0]
+
+
+async def test_redis_down_then_other_workers_resync(redis_server):
+    asked = record("resync")
+    redis_server.connected = False
+    await bus.publish("solve", n=0)
+    assert bus.diverged
+    redis_server.connected = True
+    await bus.publish("solve", n=1)
+    assert not bus.diverged
+    assert [m.seq for m in asked] == [1]
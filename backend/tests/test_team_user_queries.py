@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from app import db, team, user
+from app.db.models import Chall, Solve, Team, User
+
+# The list and profile endpoints without the scoreboard cache must cost the
+# same number of queries however many teams, users and solves there are.
+
+SMALL = (2, 2, 2)
+LARGE = (20, 4, 15)  # teams, users per team, challenges
+
+
+async def populate(teams: int, users_per_team: int, challs: int) -> None:
+    start = datetime(2025, 1, 1)
+    async with db.session_genr() as session:
+        async with session.begin():
+            chall_objs = [
+                Chall(
+                    name=f"chall{i}",
+                    desc="",
+                    flag=f"flag{{{i}}}",
+                    points=100 + i,
+                    initial_points=100 + i,
+                )
+                for i in range(challs)
+            ]
+            session.add_all(chall_objs)
+            for t in range(teams):
+                team_obj = Team(name=f"team{t}", pass_hash="x")
+                members = [
+                    User(
+                        username=f"user{t}-{u}",
+                        email=f"user{t}-{u}@example.com",
+                        admin=False,
+                        email_verified=True,
+                        pass_hash="x",
+                        team=team_obj,
+                    )
+                    for u in range(users_per_team)
+                ]
+                session.add_all([team_obj, *members])
+                # Each team solves a different number of challenges
+                for c, chall in enumerate(chall_objs[: t % challs + 1]):
+                    session.add(
+                        Solve(
+                            user=members[c % users_per_team],
+                            team=team_obj,
+                            chall=chall,
+                            time=start + timedelta(minutes=t * challs + c),
+                        )
+                    )
+
+
+def count_queries(engine) -> list[str]:
+    statements = []
+    event.listen(
+        engine.sync_engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return statements
+
+
+@pytest.fixture(autouse=True)
+def no_scoreboard_cache(monkeypatch):
+    monkeypatch.setattr(team, "SCOREBOARD_CACHE", False)
+    monkeypatch.setattr(user, "SCOREBOARD_CACHE", False)
+
+
+async def measure(engine, size: tuple[int, int, int]) -> dict[str, int]:
+    await populate(*size)
+    statements = count_queries(engine)
+    counts = {}
+    for name, call in (
+        ("team list", lambda: team.get_team_pub_list(None)),
+        ("user list", lambda: user.get_user_pub_list(None)),
+        ("team", lambda: team.get_team_pub(1)),
+        ("user", lambda: user.get_user_pub(1)),
+    ):
+        statements.clear()
+        await call()
+        counts[name] = len(statements)
+    return counts
+
+
+@pytest.mark.parametrize("size", [SMALL, LARGE])
+async def test_query_counts(database, size):
+    assert await measure(database, size) == {
+        "team list": 1,
+        "user list": 1,
+        "team": 3,
+        "user": 2,
+    }
+
+
+async def test_lists_are_complete(database):
+    await populate(*LARGE)
+    teams, users = LARGE[0], LARGE[0] * LARGE[1]
+    assert len((await team.get_team_pub_list(None)).teams) == teams
+    assert len((await user.get_user_pub_list(None)).users) == users
+    page = await team.get_team_pub_list(5)
+    assert len(page.teams) == 5 and page.next